@@ -0,0 +1,187 @@
+import gzip
+import threading
+from collections import OrderedDict
+from time import perf_counter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # optional; without it clients are sent gzip
+
+
+class LruCache:
+    """Thread-safe LRU cache bounded by entry count and, optionally, by total weight.
+
+    `weigh` maps a value to its weight (e.g. the number of ids it holds). Entries are
+    tagged with a generation; `set_generation` drops everything when the DB changes, and
+    put() drops a value computed under another generation than the current one.
+    """
+    def __init__(self, max_entries: int, max_weight: int=0, weigh=None):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.weigh = weigh or (lambda value: 1)
+
+        self.generation = None
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+
+    def set_generation(self, generation: int):
+        with self._lock:
+            if generation == self.generation:
+                return
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.weight = 0
+            self.generation = generation
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+
+    def put(self, key, value, generation: int=None):
+        """`generation` is the one the value was computed under, if the cache has generations."""
+        if not self.enabled:
+            return
+
+        weight = self.weigh(value)
+        if self.max_weight and weight > self.max_weight:
+            return # would evict everything else and still not fit
+
+        with self._lock:
+            if generation != self.generation:
+                return # the DB changed while the value was being computed
+            if key in self._entries:
+                self.weight -= self._entries.pop(key)[1]
+            self._entries[key] = (value, weight)
+            self.weight += weight
+
+            while len(self._entries) > self.max_entries or (self.max_weight and self.weight > self.max_weight):
+                _, (_, evicted_weight) = self._entries.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'weight': self.weight,
+                'max_weight': self.max_weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'generation': self.generation,
+            }
+
+
+class EncodedCache:
+    """Response bodies kept serialized and compressed, ready to send as they are.
+
+    One body per key, built by the caller on a miss. Like LruCache, everything is dropped
+    when the generation changes, so a body is built and compressed once per DB change.
+    """
+    def __init__(self, gzip_level: int=6, brotli_quality: int=9):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.build_seconds = 0.0
+
+        self._entries: dict[str, dict[str, bytes]] = {}
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock() # one build at a time, the rest wait and hit
+
+
+    @property
+    def encodings(self) -> tuple[str, ...]:
+        return ('br', 'gzip') if brotli else ('gzip',)
+
+
+    def _lookup(self, key: str, generation: int) -> dict[str, bytes] | None:
+        with self._lock:
+            if generation != self.generation:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.generation = generation
+            return self._entries.get(key)
+
+
+    def get(self, key: str, generation: int, build) -> dict[str, bytes]:
+        """The body for `key` by encoding ('identity', 'gzip' and, with brotli installed, 'br').
+
+        `build()` returns the uncompressed bytes.
+        """
+        bodies = self._lookup(key, generation)
+        if bodies is not None:
+            with self._lock:
+                self.hits += 1
+            return bodies
+
+        with self._build_lock:
+            bodies = self._lookup(key, generation)
+            if bodies is not None:
+                with self._lock:
+                    self.hits += 1
+                return bodies
+
+            start = perf_counter()
+            body = build()
+            bodies = {'identity': body, 'gzip': gzip.compress(body, self.gzip_level)}
+            if brotli:
+                bodies['br'] = brotli.compress(body, quality=self.brotli_quality)
+
+            with self._lock:
+                self.misses += 1
+                self.build_seconds += perf_counter() - start
+                if generation == self.generation:
+                    self._entries[key] = bodies
+            return bodies
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': {key: {encoding: len(body) for encoding, body in bodies.items()} for key, bodies in self._entries.items()},
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'avg_build_ms': round(1000 * self.build_seconds / self.misses, 3) if self.misses else 0.0,
+                'generation': self.generation,
+                'encodings': self.encodings,
+            }
@@ -6,7 +6,7 @@ from enums import Ext
 from utils import make_path
 
 
-config_path = make_path('..', 'configs.toml')
+config_path = os.environ.get('TAGGER_CONFIGS') or make_path('..', 'configs.toml') # e.g. set by utility/bench_http.py
 
 
 try:
@@ -27,6 +27,11 @@ class TaggerConfigs:
         self.sql_echo = configs.get('sql_echo', False)
         self.sql_insert_batch_size = configs.get('sql_insert_batch_size', 10_000)
         self.commit_tags = configs.get('commit_tags', True)
+        self.sqlite_wal = configs.get('sqlite_wal', False)
+        self.sqlite_busy_timeout = configs.get('sqlite_busy_timeout', 5.0)
+        self.sqlite_wal_autocheckpoint = configs.get('sqlite_wal_autocheckpoint', 1000)
+        self.verify_workers = configs.get('verify_workers', 8)
+        self.max_jobs = configs.get('max_jobs', 2)
 
         self.cpu = configs.get('cpu', False)
         self.tag_model_repo_id = configs.get('tag_model_repo_id', 'SmilingWolf/wd-swinv2-tagger-v3')
@@ -38,6 +43,10 @@ class TaggerConfigs:
         self.min_character_tag_val = configs.get('min_character_tag_val', 0.2)
 
         self.commit_sha256 = configs.get('commit_sha256', True)
+        self.tagger_thumbnails = configs.get('tagger_thumbnails', False)
+        self.tagger_meta = configs.get('tagger_meta', False)
+        self.exiftool_processes = configs.get('exiftool_processes', 2)
+        self.meta_fields = tuple(configs.get('meta_fields', ['Make', 'Model', 'LensModel', 'DateTimeOriginal', 'Software', 'Artist', 'Rating', 'Subject', 'Keywords']))
 
         valid_extensions = configs.get('valid_extensions', 'png,jpeg,jpg,gif,webp,avif,apng,tif,tiff')
         self.valid_extensions = tuple([v.strip() for v in valid_extensions.split(',')])
@@ -48,7 +57,23 @@ class TaggerConfigs:
         self.port = configs.get('port')
         self.debug = configs.get('debug')
         self.allow_file_upload_search = configs.get('allow_file_upload_search', False)
+        self.inference_max_batch = configs.get('inference_max_batch', 8)
+        self.inference_max_wait_ms = configs.get('inference_max_wait_ms', 10)
+        self.upload_cache_entries = configs.get('upload_cache_entries', 256)
         self.web_media_roots = tuple(configs.get('web_media_roots', []))
+        self.media_max_age = configs.get('media_max_age', 86400)
+
+        self.search_cache_entries = configs.get('search_cache_entries', 128)
+        self.search_cache_max_ids = configs.get('search_cache_max_ids', 5_000_000)
+        self.query_stats = configs.get('query_stats', True)
+        self.slow_query_ms = configs.get('slow_query_ms', 250)
+
+        self.thumbnail_dir = configs.get('thumbnail_dir', make_path('..', 'thumbnails'))
+        self.thumbnail_size = configs.get('thumbnail_size', 256)
+        self.thumbnail_format = configs.get('thumbnail_format', 'webp')
+        self.thumbnail_quality = configs.get('thumbnail_quality', 80)
+        self.thumbnail_cache_mb = configs.get('thumbnail_cache_mb', 2048)
+        self.thumbnail_workers = configs.get('thumbnail_workers', 4)
 
 
 configs = TaggerConfigs(user_configs)
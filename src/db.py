@@ -1,22 +1,59 @@
+import json
 import sqlite3
+from array import array
 from datetime import datetime
 from functools import lru_cache
+from itertools import batched
 import os
 import random
 
 from enums import Ratings, TagData, TagType
 from sqlitedb import SqliteDb, get_placeholders
 from tag_data import get_tag_data
-from utils import get_sha256_from_path
+from utils import get_sha256_from_path, permuted_index
+
+
+def folder_clause(column: str, folder: str, subtree: bool=True) -> tuple[str, tuple]:
+    """SQL matching the directory `folder` and, with subtree=True, every directory below it.
+
+    Below a folder means sharing its path plus a separator as a prefix, so the subtree is a
+    range scan on the directory index instead of a LIKE scan.
+    """
+    folder = folder.rstrip('/' + os.sep) or folder[:1] # keep a bare root separator
+    if not subtree:
+        return f'{column} = ?', (folder,)
+
+    clauses = [f'{column} = ?']
+    params = [folder]
+    for sep in sorted({'/', os.sep}):
+        prefix = folder if folder.endswith(sep) else folder + sep
+        clauses.append(f'({column} >= ? and {column} < ?)')
+        params += [prefix, prefix[:-1] + chr(ord(sep) + 1)]
+    return '(' + ' or '.join(clauses) + ')', tuple(params)
+
+
+def meta_clause(column: str, meta: tuple[tuple[str, str], ...]) -> tuple[str, tuple]:
+    """SQL matching images having every (field, value) pair of `meta` in image_meta_field."""
+    clauses = [f'{column} in (select image_id from image_meta_field where field = ? and value = ?)' for _ in meta]
+    return ' and '.join(clauses), tuple(param for pair in meta for param in pair)
 
 
 class ImageDb(SqliteDb):
-    def __init__(self, db_path, sql_echo=False):
-        super().__init__(db_path, sql_echo)
+    def __init__(self, db_path, sql_echo=False, wal=False, busy_timeout=5.0, wal_autocheckpoint=1000):
+        super().__init__(db_path, sql_echo, wal=wal, busy_timeout=busy_timeout, wal_autocheckpoint=wal_autocheckpoint)
 
         self.directory_2_id: dict = {}
         self.total_csv_tag_count = 10_861
 
+        # optional LruCache of ordered search results, see get_images_by_tag_ids
+        self.search_cache = None
+
+        # the library's root_path from the configs, above which directories get no parents, see get_directory_id
+        self.root_path = None
+
+        # whether the tag_fts index exists, see search_tag_names
+        self._tag_fts = None
+
 
     def is_tags_exist(self) -> bool:
         tag_count = self.run_query_tuple('select count(*) from tag')[0][0]
@@ -46,6 +83,7 @@ class ImageDb(SqliteDb):
                 directory_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 mark SMALLINT DEFAULT 0,
                 directory TEXT NOT NULL,
+                parent_id INTEGER, -- the containing directory, null at the top of the library
                 FOREIGN KEY (directory_id) REFERENCES image(directory_id) ON DELETE CASCADE,
                 UNIQUE(directory)
             );
@@ -82,6 +120,181 @@ class ImageDb(SqliteDb):
                 updated_at TEXT NOT NULL,
                 PRIMARY KEY(tag_name, tag_id)
             )
+        ""","""
+            CREATE TABLE IF NOT EXISTS db_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ""","""
+            insert or ignore into db_meta (key, value) values ('generation', 0)
+        ""","""
+            CREATE TABLE IF NOT EXISTS image_meta (
+                image_id INTEGER PRIMARY KEY,  -- exiftool output for the image, see metadata.py
+                mtime_ns INTEGER NOT NULL,     -- of the file when it was read
+                meta TEXT NOT NULL             -- json
+            )
+        ""","""
+            CREATE TABLE IF NOT EXISTS image_meta_field (
+                image_id INTEGER NOT NULL,     -- the configured meta_fields of image_meta, for searching
+                field TEXT NOT NULL,
+                value TEXT NOT NULL,           -- one row per item of list values
+                PRIMARY KEY (image_id, field, value)
+            ) WITHOUT ROWID
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_delete_meta AFTER DELETE ON image
+            BEGIN
+                delete from image_meta where image_id = old.image_id;
+                delete from image_meta_field where image_id = old.image_id;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_insert_count AFTER INSERT ON image_tag
+            BEGIN
+                update tag set tag_count = tag_count + 1 where tag_id = new.tag_id;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_delete_count AFTER DELETE ON image_tag
+            BEGIN
+                update tag set tag_count = tag_count - 1 where tag_id = old.tag_id;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_update_count AFTER UPDATE OF tag_id ON image_tag
+            BEGIN
+                update tag set tag_count = tag_count - 1 where tag_id = old.tag_id;
+                update tag set tag_count = tag_count + 1 where tag_id = new.tag_id;
+            END
+        ""","""
+            CREATE TABLE IF NOT EXISTS tag_stats (
+                tag_id INTEGER PRIMARY KEY,    -- images tagged with prob >= 0.6, by rating bucket
+                n INTEGER NOT NULL DEFAULT 0,  -- all
+                g INTEGER NOT NULL DEFAULT 0,  -- general >= 0.5 (explore)
+                s INTEGER NOT NULL DEFAULT 0,
+                q INTEGER NOT NULL DEFAULT 0,
+                x INTEGER NOT NULL DEFAULT 0,
+                cloud_g INTEGER NOT NULL DEFAULT 0,  -- general >= 0.6 (cloud)
+                cloud_s INTEGER NOT NULL DEFAULT 0,
+                cloud_q INTEGER NOT NULL DEFAULT 0,
+                cloud_x INTEGER NOT NULL DEFAULT 0
+            )
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_insert_stats AFTER INSERT ON image_tag WHEN new.prob >= 0.6
+            BEGIN
+                insert into tag_stats (tag_id, n, g, s, q, x, cloud_g, cloud_s, cloud_q, cloud_x)
+                select new.tag_id, 1,
+                    ifnull(general, 0) >= 0.5, ifnull(sensitive, 0) >= 0.5, ifnull(questionable, 0) >= 0.5, ifnull(explicit, 0) >= 0.5,
+                    ifnull(general, 0) >= 0.6, ifnull(sensitive, 0) >= 0.6, ifnull(questionable, 0) >= 0.6, ifnull(explicit, 0) >= 0.6
+                from image where image_id = new.image_id
+                on conflict(tag_id) do update set
+                    n = n + excluded.n, g = g + excluded.g, s = s + excluded.s, q = q + excluded.q, x = x + excluded.x,
+                    cloud_g = cloud_g + excluded.cloud_g, cloud_s = cloud_s + excluded.cloud_s,
+                    cloud_q = cloud_q + excluded.cloud_q, cloud_x = cloud_x + excluded.cloud_x;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_delete_stats AFTER DELETE ON image_tag WHEN old.prob >= 0.6
+            BEGIN
+                update tag_stats set
+                    n = n - 1,
+                    g = g - (select ifnull(general, 0) >= 0.5 from image where image_id = old.image_id),
+                    s = s - (select ifnull(sensitive, 0) >= 0.5 from image where image_id = old.image_id),
+                    q = q - (select ifnull(questionable, 0) >= 0.5 from image where image_id = old.image_id),
+                    x = x - (select ifnull(explicit, 0) >= 0.5 from image where image_id = old.image_id),
+                    cloud_g = cloud_g - (select ifnull(general, 0) >= 0.6 from image where image_id = old.image_id),
+                    cloud_s = cloud_s - (select ifnull(sensitive, 0) >= 0.6 from image where image_id = old.image_id),
+                    cloud_q = cloud_q - (select ifnull(questionable, 0) >= 0.6 from image where image_id = old.image_id),
+                    cloud_x = cloud_x - (select ifnull(explicit, 0) >= 0.6 from image where image_id = old.image_id)
+                where tag_id = old.tag_id;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_rating_stats AFTER UPDATE OF general, sensitive, questionable, explicit ON image
+            BEGIN
+                update tag_stats set
+                    g = g - (ifnull(old.general, 0) >= 0.5) + (ifnull(new.general, 0) >= 0.5),
+                    s = s - (ifnull(old.sensitive, 0) >= 0.5) + (ifnull(new.sensitive, 0) >= 0.5),
+                    q = q - (ifnull(old.questionable, 0) >= 0.5) + (ifnull(new.questionable, 0) >= 0.5),
+                    x = x - (ifnull(old.explicit, 0) >= 0.5) + (ifnull(new.explicit, 0) >= 0.5),
+                    cloud_g = cloud_g - (ifnull(old.general, 0) >= 0.6) + (ifnull(new.general, 0) >= 0.6),
+                    cloud_s = cloud_s - (ifnull(old.sensitive, 0) >= 0.6) + (ifnull(new.sensitive, 0) >= 0.6),
+                    cloud_q = cloud_q - (ifnull(old.questionable, 0) >= 0.6) + (ifnull(new.questionable, 0) >= 0.6),
+                    cloud_x = cloud_x - (ifnull(old.explicit, 0) >= 0.6) + (ifnull(new.explicit, 0) >= 0.6)
+                where tag_id in (select tag_id from image_tag where image_id = new.image_id and prob >= 0.6);
+            END
+        ""","""
+            CREATE TABLE IF NOT EXISTS tag_pair_stats (
+                tag_id INTEGER NOT NULL,        -- images where both tags have prob >= 0.6, by rating bucket
+                other_tag_id INTEGER NOT NULL,  -- every pair is stored in both directions
+                n INTEGER NOT NULL DEFAULT 0,
+                g INTEGER NOT NULL DEFAULT 0,
+                s INTEGER NOT NULL DEFAULT 0,
+                q INTEGER NOT NULL DEFAULT 0,
+                x INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tag_id, other_tag_id)
+            ) WITHOUT ROWID
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_insert_pairs AFTER INSERT ON image_tag WHEN new.prob >= 0.6
+            BEGIN
+                insert into tag_pair_stats (tag_id, other_tag_id, n, g, s, q, x)
+                select new.tag_id, image_tag.tag_id, 1,
+                    ifnull(general, 0) >= 0.5, ifnull(sensitive, 0) >= 0.5, ifnull(questionable, 0) >= 0.5, ifnull(explicit, 0) >= 0.5
+                from image_tag join image using(image_id)
+                where image_tag.image_id = new.image_id and image_tag.prob >= 0.6 and image_tag.tag_id != new.tag_id
+                on conflict(tag_id, other_tag_id) do update set
+                    n = n + excluded.n, g = g + excluded.g, s = s + excluded.s, q = q + excluded.q, x = x + excluded.x;
+                insert into tag_pair_stats (tag_id, other_tag_id, n, g, s, q, x)
+                select image_tag.tag_id, new.tag_id, 1,
+                    ifnull(general, 0) >= 0.5, ifnull(sensitive, 0) >= 0.5, ifnull(questionable, 0) >= 0.5, ifnull(explicit, 0) >= 0.5
+                from image_tag join image using(image_id)
+                where image_tag.image_id = new.image_id and image_tag.prob >= 0.6 and image_tag.tag_id != new.tag_id
+                on conflict(tag_id, other_tag_id) do update set
+                    n = n + excluded.n, g = g + excluded.g, s = s + excluded.s, q = q + excluded.q, x = x + excluded.x;
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_delete_pairs AFTER DELETE ON image_tag WHEN old.prob >= 0.6
+            BEGIN
+                update tag_pair_stats set
+                    n = n - 1,
+                    g = g - (select ifnull(general, 0) >= 0.5 from image where image_id = old.image_id),
+                    s = s - (select ifnull(sensitive, 0) >= 0.5 from image where image_id = old.image_id),
+                    q = q - (select ifnull(questionable, 0) >= 0.5 from image where image_id = old.image_id),
+                    x = x - (select ifnull(explicit, 0) >= 0.5 from image where image_id = old.image_id)
+                where tag_id = old.tag_id and other_tag_id in (select tag_id from image_tag where image_id = old.image_id and prob >= 0.6);
+                update tag_pair_stats set
+                    n = n - 1,
+                    g = g - (select ifnull(general, 0) >= 0.5 from image where image_id = old.image_id),
+                    s = s - (select ifnull(sensitive, 0) >= 0.5 from image where image_id = old.image_id),
+                    q = q - (select ifnull(questionable, 0) >= 0.5 from image where image_id = old.image_id),
+                    x = x - (select ifnull(explicit, 0) >= 0.5 from image where image_id = old.image_id)
+                where other_tag_id = old.tag_id and tag_id in (select tag_id from image_tag where image_id = old.image_id and prob >= 0.6);
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_rating_pairs AFTER UPDATE OF general, sensitive, questionable, explicit ON image
+            BEGIN
+                update tag_pair_stats set
+                    g = g - (ifnull(old.general, 0) >= 0.5) + (ifnull(new.general, 0) >= 0.5),
+                    s = s - (ifnull(old.sensitive, 0) >= 0.5) + (ifnull(new.sensitive, 0) >= 0.5),
+                    q = q - (ifnull(old.questionable, 0) >= 0.5) + (ifnull(new.questionable, 0) >= 0.5),
+                    x = x - (ifnull(old.explicit, 0) >= 0.5) + (ifnull(new.explicit, 0) >= 0.5)
+                where tag_id in (select tag_id from image_tag where image_id = new.image_id and prob >= 0.6)
+                  and other_tag_id in (select tag_id from image_tag where image_id = new.image_id and prob >= 0.6);
+            END
+        ""","""
+            CREATE TABLE IF NOT EXISTS tag_rep_image (
+                tag_id INTEGER PRIMARY KEY,   -- example image shown for the tag, see refresh_tag_rep_images
+                image_id INTEGER NOT NULL
+            )
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_insert_rep AFTER INSERT ON image_tag
+            BEGIN
+                -- the first image of a tag stands in until the next refresh picks the best one
+                insert or ignore into tag_rep_image (tag_id, image_id) values (new.tag_id, new.image_id);
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_image_tag_delete_rep AFTER DELETE ON image_tag
+            BEGIN
+                -- any remaining image will do until the next refresh
+                update tag_rep_image set image_id = (select image_id from image_tag where tag_id = old.tag_id limit 1)
+                where tag_id = old.tag_id and image_id = old.image_id
+                  and exists (select 1 from image_tag where tag_id = old.tag_id);
+                delete from tag_rep_image where tag_id = old.tag_id and image_id = old.image_id;
+            END
         ""","""
             create view IF NOT EXISTS tags_for_images_prob60_v2 AS
             select tag.tag_id, tag.tag_name, image_tag.image_id, image_tag.prob, image.explicit, image.sensitive, image.questionable, image.general
@@ -114,16 +327,60 @@ class ImageDb(SqliteDb):
 
         CREATE INDEX IF NOT EXISTS idx_directory_id         ON directory(directory_id);
         CREATE INDEX IF NOT EXISTS idx_directory_directory  ON directory(directory);
+        CREATE INDEX IF NOT EXISTS idx_directory_parent_id  ON directory(parent_id);
         
         CREATE INDEX IF NOT EXISTS idx_image_tag_image_id           ON image_tag (image_id);
         CREATE INDEX IF NOT EXISTS idx_image_tag_tag_id             ON image_tag (tag_id);
+
+        CREATE INDEX IF NOT EXISTS idx_tag_lower_name               ON tag (lower(tag_name));
+
+        CREATE INDEX IF NOT EXISTS idx_image_meta_field_field_value ON image_meta_field (field, value);
         """
 
         sqls += [s.strip() for s in idxs.split('\n') if s.strip()]
 
+        # databases from before the tag_count triggers need one recount
+        has_count_triggers = self.run_query_tuple("select count(*) from sqlite_master where type = 'trigger' and name = 'trg_image_tag_insert_count'")[0][0]
+        has_tag_stats = self.run_query_tuple("select count(*) from sqlite_master where type = 'table' and name = 'tag_stats'")[0][0]
+        has_tag_pair_stats = self.run_query_tuple("select count(*) from sqlite_master where type = 'table' and name = 'tag_pair_stats'")[0][0]
+        # tag_rep_image from before its insert trigger can be missing tags, so it is refilled once
+        has_tag_rep_image = self.run_query_tuple("select count(*) from sqlite_master where type = 'trigger' and name = 'trg_image_tag_insert_rep'")[0][0]
+        has_tag_fts = self.has_tag_fts()
+
+        # databases from before directory.parent_id need the column and a backfill
+        directory_columns = [row[1] for row in self.run_query_tuple('pragma table_info(directory)')]
+        has_parent_ids = not directory_columns or 'parent_id' in directory_columns
+        if not has_parent_ids:
+            self.run_query_tuple('alter table directory add column parent_id INTEGER', commit=True)
+
         for s in sqls:
             self.run_query_dict(s, commit=True)
 
+        if not has_tag_fts:
+            self.init_tag_fts()
+
+        if not has_parent_ids:
+            self.backfill_directory_parents()
+
+        if self.root_path:
+            self.detach_directories_above_root()
+
+        if not has_count_triggers:
+            self.update_tag_counts()
+            self.save()
+
+        if not has_tag_stats:
+            self.refresh_tag_stats()
+            self.save()
+
+        if not has_tag_pair_stats:
+            self.refresh_tag_pair_stats()
+            self.save()
+
+        if not has_tag_rep_image:
+            self.refresh_tag_rep_images()
+            self.save()
+
         tags_exist = self.is_tags_exist()
 
         if not tags_exist:
@@ -134,6 +391,16 @@ class ImageDb(SqliteDb):
             self.insert_tags()
 
 
+    def get_generation(self) -> int:
+        """The DB generation, bumped by every write path. Used to invalidate caches."""
+        rows = self.run_query_tuple("select value from db_meta where key = 'generation'")
+        return int(rows[0][0]) if rows else 0
+
+
+    def bump_generation(self, commit: bool=False):
+        self.run_query_tuple("update db_meta set value = value + 1 where key = 'generation'", commit=commit)
+
+
     @lru_cache
     def get_directory_id(self, directory: str) -> int:
         """
@@ -145,8 +412,12 @@ class ImageDb(SqliteDb):
         if directory_id := self.directory_2_id.get(directory):
             return directory_id
 
-        sql_string = '''insert or ignore into directory (directory) values (?) returning directory_id'''
-        rows = self.run_query_tuple(sql_string, params=(directory,), commit=True)
+        # ancestors get rows too, so every directory has a parent_id up to the top of the library
+        parent = self._parent_directory(directory)
+        parent_id = self.get_directory_id(parent) if parent else None
+
+        sql_string = '''insert or ignore into directory (directory, parent_id) values (?, ?) returning directory_id'''
+        rows = self.run_query_tuple(sql_string, params=(directory, parent_id), commit=True)
 
         if not rows:
             # https://sqlite.org/lang_returning.html
@@ -160,6 +431,74 @@ class ImageDb(SqliteDb):
         self.directory_2_id[directory] = directory_id
         return directory_id
 
+    def _parent_directory(self, directory: str) -> str:
+        """The parent to link `directory` to, or None at the filesystem root and, with root_path set,
+        for the library's top-level folders and anything outside the library."""
+        parent = os.path.dirname(directory)
+        if not parent or parent == directory:
+            return None
+        if self.root_path and (parent == self.root_path or not parent.startswith(os.path.join(self.root_path, ''))):
+            return None
+        return parent
+
+    def backfill_directory_parents(self):
+        """Set parent_id on directories from before the column existed, creating ancestor rows as needed."""
+        rows = self.run_query_tuple('select directory_id, directory from directory where parent_id is null')
+        for directory_id, directory in rows:
+            if parent := self._parent_directory(directory):
+                self.run_query_tuple('update directory set parent_id = ? where directory_id = ?', (self.get_directory_id(parent), directory_id))
+        self.save()
+
+    def detach_directories_above_root(self):
+        """Unlink directories from parents at or above root_path, and delete those parents if they hold no images.
+        Databases from before get_directory_id stopped at root_path have rows for every ancestor of the library."""
+        below_sql, below_params = folder_clause('directory', self.root_path)
+        not_below = f'(directory = ? or not {below_sql})'
+        not_below_params = (self.root_path, *below_params)
+
+        if not self.run_query_tuple(f'select 1 from directory where parent_id in (select directory_id from directory where {not_below}) limit 1', not_below_params):
+            return
+
+        self.run_query_tuple(f'update directory set parent_id = null where parent_id in (select directory_id from directory where {not_below})', not_below_params)
+        rows = self.run_query_tuple(f'select directory_id, directory from directory where {not_below}', not_below_params)
+        # deepest first, so emptied ancestors go too
+        rows.sort(key=lambda row: len(row[1]), reverse=True)
+        self.delete_empty_directories([directory_id for directory_id, _ in rows])
+        self.bump_generation()
+        self.save()
+
+    def get_child_directories(self, parent_id: int=None) -> list[dict]:
+        """The directories directly below parent_id (the top-level ones if None), with their own image counts."""
+        parent = 'parent_id = ?' if parent_id is not None else 'parent_id is null'
+        sql = f"""
+            select directory_id, directory,
+                (select count(*) from image where image.directory_id = directory.directory_id) as image_count,
+                exists (select 1 from directory child where child.parent_id = directory.directory_id) as has_children
+            from directory
+            where {parent}
+            order by directory
+        """
+        return self._run_query(sql, params=(parent_id,) if parent_id is not None else ())
+
+    def get_folder_image_ids(self, folder: str, subtree: bool=False) -> list[int]:
+        """Images in a folder, or with subtree=True also in every folder below it."""
+        where, params = folder_clause('directory.directory', folder, subtree)
+        rows = self.run_query_tuple(f'select image.image_id from image join directory using(directory_id) where {where}', params)
+        return [row[0] for row in rows]
+
+    def get_folder_tag_names(self, folder: str, subtree: bool=False) -> list[str]:
+        """Names of the tags on images in a folder, or with subtree=True also in every folder below it."""
+        where, params = folder_clause('directory.directory', folder, subtree)
+        rows = self.run_query_tuple(f"""
+            select distinct tag.tag_name
+            from directory join image using(directory_id)
+                           join image_tag using(image_id)
+                           join tag using(tag_id)
+            where {where}
+            order by tag.tag_name
+        """, params)
+        return [row[0] for row in rows]
+
     def insert_tags(self, tag_data: TagData=None):
         if not tag_data:
             tag_data = get_tag_data()
@@ -231,6 +570,8 @@ class ImageDb(SqliteDb):
             error_msg = str(e).join('\n')[:256]
             print(f'Unique constraint failed: {image_id=} {tag_id_2_prob=} {params=} {error_msg=}')
 
+        self.bump_generation()
+
 
     def _fetch_results(self, image_ids: list[int]) -> list[dict]:
         if len(image_ids) < 1:
@@ -286,6 +627,30 @@ class ImageDb(SqliteDb):
         return result
 
 
+    def get_tagger_tags_by_sha256(self, sha256: str, min_general_tag_val: float, min_character_tag_val: float) -> tuple[dict, dict, dict] | None:
+        """The stored tagger output for a tagged image with this sha256, as (rating_tags, char_tags, gen_tags)
+        keyed by tag_id like process_images_from_imgs(by_idx=True). None if no such image has been tagged.
+        """
+        rows = self.run_query_tuple('select image_id, general, sensitive, questionable, explicit from image where sha256 = ? and general is not null limit 1', (sha256,))
+        if not rows:
+            return None
+        image_id, *ratings = rows[0]
+        rating_by_name = dict(zip(('general', 'sensitive', 'questionable', 'explicit'), ratings))
+
+        rating_tags = {tag_id: rating_by_name[tag_name] for tag_id, tag_name in self.run_query_tuple(
+            'select tag_id, tag_name from tag where tag_type_id = ?', (TagType.rating.value,)) if tag_name in rating_by_name}
+
+        # only the model's own tags: user-created ones (tag_id past the csv) aren't in tag_data.names
+        char_tags, gen_tags = {}, {}
+        sql = 'select tag_id, tag_type_id, prob from image_tag join tag using(tag_id) where image_id = ? and tag_type_id in (?, ?) and tag_id < ?'
+        for tag_id, tag_type_id, prob in self.run_query_tuple(sql, (image_id, TagType.character.value, TagType.general.value, self.total_csv_tag_count)):
+            if tag_type_id == TagType.character.value and prob > min_character_tag_val:
+                char_tags[tag_id] = prob
+            elif tag_type_id == TagType.general.value and prob > min_general_tag_val:
+                gen_tags[tag_id] = prob
+        return rating_tags, char_tags, gen_tags
+
+
     def get_tags_by_tag_name(self, tag_name: str) -> list[dict]:
         s = """select distinct image_tag.image_id from tag join image_tag on tag.tag_id = image_tag.tag_id where tag.tag_name = ?"""
         rows = self.run_query_tuple(s, (tag_name,))
@@ -296,9 +661,9 @@ class ImageDb(SqliteDb):
         return results
 
 
-    @lru_cache()
     def get_tags(self) -> list[tuple]:
-        rows = self.run_query_tuple('select tag_id, lower(tag_name), tag_type_id, tag_type_name from tag join tag_type using(tag_type_id) where tag_count > 0 order by lower(tag_name)')
+        # user-created tags are listed even before they are applied to any image
+        rows = self.run_query_tuple('select tag_id, lower(tag_name), tag_type_id, tag_type_name from tag join tag_type using(tag_type_id) where tag_count > 0 or tag_id >= ? order by lower(tag_name)', (self.total_csv_tag_count,))
         if not rows:
             return []
         return rows
@@ -315,179 +680,472 @@ class ImageDb(SqliteDb):
         return self._get_image_count(datetime.now().strftime('%Y%m%d'))
 
 
+    def iter_all_images(self, chunk_size: int=1_000):
+        """Every image as a _fetch_results dict, in image_id order, holding one chunk in memory at a time."""
+        last_image_id = -1
+        while True:
+            image_ids = [row[0] for row in self.run_query_tuple('select image_id from image where image_id > ? order by image_id limit ?', (last_image_id, chunk_size))]
+            if not image_ids:
+                return
+            yield from self._fetch_results(image_ids)
+            last_image_id = image_ids[-1]
+
+
     def _get_all_images(self) -> list[dict]:
         """Used for testing on small data sets"""
-        rows = self.run_query_tuple("""select image_id from image order by image_id""")
+        return list(self.iter_all_images())
 
-        if not rows:
-            return []
 
-        image_ids = [row[0] for row in rows]
+    def count_untagged_images(self) -> int:
+        return self.run_query_tuple('select count(*) from image where general is null')[0][0]
 
-        results = self._fetch_results(image_ids)
-        return results
 
+    def iter_untagged_images(self, chunk_size: int=10_000):
+        """Yield (directory_id, directory, filename) for images without tags, in image_id order.
 
-    def get_untagged_images(self) -> set[tuple[int, str, str]]:
-        sql = f"""
-        select
-            directory_id, directory, filename
-        from image
-            join directory using (directory_id)
-        where general is null
+        Rows are read in keyset chunks, so the caller can tag (and commit) images between chunks
+        without a query being open on the rows it is changing.
         """
-        return set((row[0], row[1], row[2]) for row in (self.run_query_tuple(sql)))
-
-
-    def get_images_by_tag_ids(self, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, page: int, per_page: int) -> list[dict]:
-      
-        # TODO should this be COUNT(image_tag.image_id)?
-        total_rows = self.run_query_tuple(f"""
-            select image_tag.image_id
-            from image join image_tag using(image_id)
-                       join directory using(directory_id)
-            where
-                image_tag.tag_id in ({get_placeholders(tag_ids)})
-                and image_tag.prob >= ?
-                and general >= ?
-                and sensitive >= ?
-                and questionable >= ?
-                and explicit >= ?
-            group by image_tag.image_id
-            having count(distinct image_tag.tag_id) = ?
-            order by directory.directory""",
-#            order by max(image_tag.prob) desc""",
-            params=tag_ids + [f_tag, f_general, f_sensitive, f_questionable, f_explicit, len(tag_ids)]
-        )
-        if not total_rows:
+        last_image_id = -1
+        while True:
+            rows = self.run_query_tuple("""
+                select image_id, directory_id, directory, filename
+                from image
+                    join directory using (directory_id)
+                where general is null and image_id > ?
+                order by image_id
+                limit ?
+            """, (last_image_id, chunk_size))
+            if not rows:
+                return
+            for row in rows:
+                yield row[1], row[2], row[3]
+            last_image_id = rows[-1][0]
+
+
+    def count_images_without_meta(self) -> int:
+        return self.run_query_tuple('select count(*) from image where not exists (select 1 from image_meta where image_meta.image_id = image.image_id)')[0][0]
+
+
+    def iter_images_without_meta(self, chunk_size: int=10_000):
+        """Yield (image_id, path) for images with no stored metadata, in image_id order, read in keyset chunks."""
+        last_image_id = -1
+        while True:
+            rows = self.run_query_tuple("""
+                select image_id, directory, filename
+                from image
+                    join directory using (directory_id)
+                where image_id > ?
+                    and not exists (select 1 from image_meta where image_meta.image_id = image.image_id)
+                order by image_id
+                limit ?
+            """, (last_image_id, chunk_size))
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], os.path.join(row[1], row[2])
+            last_image_id = rows[-1][0]
+
+
+    def get_image_meta(self, image_id: int, mtime_ns: int=None) -> dict | None:
+        """The stored exiftool output for an image; None if there is none, or it was read from a file with another mtime."""
+        rows = self.run_query_tuple('select mtime_ns, meta from image_meta where image_id = ?', (image_id,))
+        if not rows or (mtime_ns is not None and rows[0][0] != mtime_ns):
+            return None
+        return json.loads(rows[0][1])
+
+
+    def save_image_meta(self, rows: list[tuple[int, int, dict]], fields: tuple[str, ...]) -> int:
+        """Store (image_id, mtime_ns, meta) rows of exiftool output, replacing any earlier metadata,
+        with the values of `fields` copied to image_meta_field for searching. Not committed."""
+        if not rows:
+            return 0
+
+        field_rows = []
+        for image_id, _, meta in rows:
+            for field in fields:
+                values = meta.get(field)
+                if values is None:
+                    continue
+                for value in (values if isinstance(values, list) else [values]):
+                    field_rows.append((image_id, field, str(value)))
+
+        params = [(image_id,) for image_id, _, _ in rows]
+        self.run_write_many('delete from image_meta_field where image_id = ?', params)
+        count = self.run_write_many('insert or replace into image_meta (image_id, mtime_ns, meta) values (?, ?, ?)',
+            [(image_id, mtime_ns, json.dumps(meta)) for image_id, mtime_ns, meta in rows])
+        self.run_write_many('insert or ignore into image_meta_field (image_id, field, value) values (?, ?, ?)', field_rows)
+        self.bump_generation()
+        return count
+
+
+    def get_meta_values(self, field: str, limit: int=100) -> list[dict]:
+        """The most common stored values of a metadata field, with their image counts."""
+        return self.run_query_dict('select value, count(*) as image_count from image_meta_field where field = ? group by value order by image_count desc, value limit ?', (field, limit))
+
+
+    def _search_image_ids(self, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, folder: str=None, meta: tuple[tuple[str, str], ...]=None) -> array:
+        """The ordered image ids matching every tag in tag_ids (all tagged images if there are none),
+        limited to the subtree of `folder` and to images with every (field, value) of `meta` if given.
+        Served from self.search_cache when possible."""
+        meta = tuple(sorted(set(meta))) if meta else ()
+        key = (tuple(sorted(set(tag_ids))), f_tag, f_general, f_sensitive, f_explicit, f_questionable, folder, meta)
+
+        folder_sql, folder_params = '', ()
+        if folder:
+            folder_sql, folder_params = folder_clause('directory.directory', folder, subtree=True)
+            folder_sql = 'and ' + folder_sql
+        if meta:
+            meta_sql, meta_params = meta_clause('image.image_id', meta)
+            folder_sql += ' and ' + meta_sql
+            folder_params += meta_params
+
+        generation = None
+        if self.search_cache is not None:
+            generation = self.get_generation()
+            self.search_cache.set_generation(generation)
+            image_ids = self.search_cache.get(key)
+            if image_ids is not None:
+                return image_ids
+
+        if not tag_ids:
+            # every tagged image
+            rows = self.run_query_tuple(f"""
+                select image.image_id
+                from image join directory using(directory_id)
+                where
+                    general >= ?
+                    and sensitive >= ?
+                    and questionable >= ?
+                    and explicit >= ?
+                    and exists (select 1 from image_tag where image_tag.image_id = image.image_id)
+                    {folder_sql}
+                order by directory.directory, image.filename, image.image_id""",
+                params=[f_general, f_sensitive, f_questionable, f_explicit, *folder_params]
+            )
+        else:
+            rows = self.run_query_tuple(f"""
+                select image_tag.image_id
+                from image join image_tag using(image_id)
+                           join directory using(directory_id)
+                where
+                    image_tag.tag_id in ({get_placeholders(tag_ids)})
+                    and image_tag.prob >= ?
+                    and general >= ?
+                    and sensitive >= ?
+                    and questionable >= ?
+                    and explicit >= ?
+                    {folder_sql}
+                group by image_tag.image_id
+                having count(distinct image_tag.tag_id) = ?
+                order by directory.directory, image.filename, image.image_id""",
+#                order by max(image_tag.prob) desc""",
+                params=list(key[0]) + [f_tag, f_general, f_sensitive, f_questionable, f_explicit, *folder_params, len(key[0])]
+            )
+        image_ids = array('q', (row[0] for row in rows))
+
+        if self.search_cache is not None:
+            self.search_cache.put(key, image_ids, generation)
+        return image_ids
+
+
+    def get_images_by_tag_ids(self, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, page: int, per_page: int, folder: str=None, meta: tuple[tuple[str, str], ...]=None) -> list[dict]:
+        image_ids = self._search_image_ids(tag_ids, f_tag, f_general, f_sensitive, f_explicit, f_questionable, folder, meta)
+        if not image_ids:
           return [], 0
-        
+
         offset = max(page - 1, 0) * per_page
-        if (offset >= len(total_rows)):
-            offset = (int)(len(total_rows) / per_page) * per_page
+        if (offset >= len(image_ids)):
+            offset = (int)(len(image_ids) / per_page) * per_page
 
-        rows = self.run_query_tuple(f"""
-            select image_tag.image_id
-            from image join image_tag using(image_id)
-                       join directory using(directory_id)
-            where
-                image_tag.tag_id in ({get_placeholders(tag_ids)})
-                and image_tag.prob >= ?
-                and general >= ?
-                and sensitive >= ?
-                and questionable >= ?
-                and explicit >= ?
-            group by image_tag.image_id
-            having count(distinct image_tag.tag_id) = ?
-            order by directory.directory
-            limit ?
-            offset ?""",
-#            order by max(image_tag.prob) desc
-            params=tag_ids + [f_tag, f_general, f_sensitive, f_questionable, f_explicit, len(tag_ids), per_page, offset]
-        )
+        page_ids = list(image_ids[offset:offset + per_page])
+        if not page_ids:
+            return [],0
+
+        results = self._fetch_results(page_ids)
+        return results,len(image_ids)
+
+
+    def get_images_by_tag_ids_after(self, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, after: tuple, per_page: int, folder: str=None, meta: tuple[tuple[str, str], ...]=None) -> tuple[list[dict], tuple]:
+        """Keyset pagination: the page of results following `after`, a (directory, filename, image_id) key.
+
+        Pass after=None for the first page. Returns the results and the key of the last one,
+        or None when there are no further pages.
+
+        Every page is read from indexes starting at `after`, so a deep page costs what the first
+        does. Usually the images are walked in key order, directories by their unique index and the
+        images in each by the (directory_id, filename) one, whose rowid is the image_id, testing each
+        for the tags until per_page + 1 match. When the rarest tag is on too few images for that walk to find them
+        quickly, its images are read from image_tag and only those are sorted.
+        """
+        tag_ids = sorted(set(tag_ids))
+
+        filters = 'general >= ? and sensitive >= ? and questionable >= ? and explicit >= ?'
+        filter_params = [f_general, f_sensitive, f_questionable, f_explicit]
+        if folder:
+            folder_sql, folder_params = folder_clause('directory.directory', folder, subtree=True)
+            filters += ' and ' + folder_sql
+            filter_params += folder_params
+        if meta:
+            meta_sql, meta_params = meta_clause('image.image_id', meta)
+            filters += ' and ' + meta_sql
+            filter_params += meta_params
+
+        driver = None
+        if tag_ids:
+            counts = dict(self.run_query_tuple(f'select tag_id, tag_count from tag where tag_id in ({get_placeholders(tag_ids)})', tag_ids))
+            rarest = min(tag_ids, key=lambda tag_id: counts.get(tag_id, 0))
+            # the walk reads about per_page * images / matches images; reading the rarest tag's images reads all of them
+            if counts.get(rarest, 0) ** 2 < (per_page + 1) * self.get_image_count():
+                driver = rarest
+
+        others = [tag_id for tag_id in tag_ids if tag_id != driver]
+        tags_sql = ''.join(' and exists (select 1 from image_tag where image_tag.image_id = image.image_id and image_tag.tag_id = ? and image_tag.prob >= ?)' for _ in others)
+        tags_params = [param for tag_id in others for param in (tag_id, f_tag)]
+        if not tag_ids:
+            tags_sql = ' and exists (select 1 from image_tag where image_tag.image_id = image.image_id)'
+
+        if driver is not None:
+            keyset, keyset_params = '', []
+            if after:
+                keyset, keyset_params = ' and (directory.directory, image.filename, image.image_id) > (?, ?, ?)', list(after)
+            rows = self.run_query_tuple(f"""
+                select image.image_id, directory.directory, image.filename
+                from image_tag driver join image using(image_id)
+                                      join directory using(directory_id)
+                where driver.tag_id = ? and driver.prob >= ? and {filters}{tags_sql}{keyset}
+                order by directory.directory, image.filename, image.image_id
+                limit ?""",
+                params=[driver, f_tag, *filter_params, *tags_params, *keyset_params, per_page + 1]
+            )
+        else:
+            def walk(where: str, params: list, limit: int) -> list[tuple]:
+                return self.run_query_tuple(f"""
+                    select image.image_id, directory.directory, image.filename
+                    from directory join image on image.directory_id = directory.directory_id
+                    where {where} and {filters}{tags_sql}
+                    order by directory.directory, image.filename, image.image_id
+                    limit ?""",
+                    params=[*params, *filter_params, *tags_params, limit]
+                )
+
+            rows = []
+            if after:
+                # the rest of the cursor's directory, then the directories after it
+                rows = walk('directory.directory = ? and (image.filename, image.image_id) > (?, ?)', list(after), per_page + 1)
+            if len(rows) <= per_page:
+                rows += walk('directory.directory > ?', [after[0] if after else ''], per_page + 1 - len(rows))
 
         if not rows:
-            return [],0
+            return [], None
 
-        image_ids = [row[0] for row in rows]
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
 
-        results = self._fetch_results(image_ids)
-        return results,len(total_rows)
+        results = self._fetch_results([row[0] for row in rows])
+        last = rows[-1]
+        return results, (last[1], last[2], last[0]) if has_more else None
 
     def update_tag_counts(self):
+        """Full recount of tag.tag_count. The image_tag triggers keep the counts current, so this is only a repair."""
         sql_string = '''update tag set tag_count=
-                 (select count(image_id) from image_tag where image_tag.tag_id=tag.tag_id) 
-                  where exists 
-                  (select * from image_tag where image_tag.tag_id = tag.tag_id)'''
+                 (select count(*) from image_tag where image_tag.tag_id=tag.tag_id)
+                  where tag_count !=
+                 (select count(*) from image_tag where image_tag.tag_id=tag.tag_id)'''
 
 # 90 percent probability
 #update tag set tag_count_90=
 #                 (select count(image_id) from image_tag where image_tag.tag_id=tag.tag_id and prob > 0.9) 
 #                  where exists 
 #                  (select * from image_tag where image_tag.tag_id = tag.tag_id)
- 
- 
 
+        self.run_query_tuple(sql_string)
+        self.bump_generation()
 
+    def verify_tag_counts(self) -> list[dict]:
+        """Tags whose tag_count disagrees with image_tag."""
+        sql = """
+            select tag.tag_id, tag.tag_name, tag.tag_count, count(image_tag.image_id) as actual
+            from tag left join image_tag using(tag_id)
+            group by tag.tag_id
+            having tag.tag_count != actual
+            order by tag.tag_id
+        """
+        return self._run_query(sql)
 
-        self.run_query_tuple(sql_string)
+    def refresh_tag_stats(self):
+        """Rebuild tag_stats from scratch. The image_tag and image triggers keep it current, so this is only a repair."""
+        self.run_query_tuple('delete from tag_stats')
+        self.run_query_tuple('''
+            insert into tag_stats (tag_id, n, g, s, q, x, cloud_g, cloud_s, cloud_q, cloud_x)
+            select image_tag.tag_id, count(*),
+                sum(ifnull(general, 0) >= 0.5), sum(ifnull(sensitive, 0) >= 0.5), sum(ifnull(questionable, 0) >= 0.5), sum(ifnull(explicit, 0) >= 0.5),
+                sum(ifnull(general, 0) >= 0.6), sum(ifnull(sensitive, 0) >= 0.6), sum(ifnull(questionable, 0) >= 0.6), sum(ifnull(explicit, 0) >= 0.6)
+            from image_tag join image using(image_id)
+            where image_tag.prob >= 0.6
+            group by image_tag.tag_id
+        ''')
+        self.bump_generation()
+
+    def refresh_tag_pair_stats(self):
+        """Rebuild tag_pair_stats from scratch. Like tag_stats, it is normally kept current by triggers."""
+        self.run_query_tuple('delete from tag_pair_stats')
+        self.run_query_tuple('''
+            insert into tag_pair_stats (tag_id, other_tag_id, n, g, s, q, x)
+            select a.tag_id, b.tag_id, count(*),
+                sum(ifnull(general, 0) >= 0.5), sum(ifnull(sensitive, 0) >= 0.5), sum(ifnull(questionable, 0) >= 0.5), sum(ifnull(explicit, 0) >= 0.5)
+            from image_tag a
+                join image_tag b on b.image_id = a.image_id and b.tag_id != a.tag_id
+                join image on image.image_id = a.image_id
+            where a.prob >= 0.6 and b.prob >= 0.6
+            group by a.tag_id, b.tag_id
+        ''')
+        self.bump_generation()
+
+    def refresh_tag_rep_images(self):
+        """Pick the most confidently tagged image of each tag as its example image. Run after tagging."""
+        self.run_query_tuple('delete from tag_rep_image')
+        # a bare column next to max() comes from the row holding the max
+        self.run_query_tuple('''
+            insert into tag_rep_image (tag_id, image_id)
+            select tag_id, image_id from (select tag_id, image_id, max(prob) from image_tag group by tag_id)
+        ''')
+
+    def has_tag_fts(self) -> bool:
+        if self._tag_fts is None:
+            self._tag_fts = bool(self.run_query_tuple("select count(*) from sqlite_master where type = 'table' and name = 'tag_fts'")[0][0])
+        return self._tag_fts
+
+    def init_tag_fts(self):
+        """Trigram index over tag names for search_tag_names. Skipped when sqlite is built without FTS5."""
+        sqls = [
+        """
+            CREATE VIRTUAL TABLE IF NOT EXISTS tag_fts USING fts5(tag_name, content='tag', content_rowid='pk', tokenize='trigram')
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_tag_insert_fts AFTER INSERT ON tag
+            BEGIN
+                insert into tag_fts (rowid, tag_name) values (new.pk, new.tag_name);
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_tag_delete_fts AFTER DELETE ON tag
+            BEGIN
+                insert into tag_fts (tag_fts, rowid, tag_name) values ('delete', old.pk, old.tag_name);
+            END
+        ""","""
+            CREATE TRIGGER IF NOT EXISTS trg_tag_update_fts AFTER UPDATE OF tag_name ON tag
+            BEGIN
+                insert into tag_fts (tag_fts, rowid, tag_name) values ('delete', old.pk, old.tag_name);
+                insert into tag_fts (rowid, tag_name) values (new.pk, new.tag_name);
+            END
+        ""","""
+            insert into tag_fts (tag_fts) values ('rebuild')
+        """
+        ]
+        try:
+            for s in sqls:
+                self.run_query_tuple(s)
+            self.save()
+            self._tag_fts = True
+        except sqlite3.OperationalError as e:
+            self.rollback()
+            self._tag_fts = False
+            print(f'Tag name index not available, autocomplete falls back to prefix search: {e}')
+
+    def search_tag_names(self, q: str, limit: int=20, tag_type_id: int=None) -> list[dict]:
+        """Tags matching `q` for autocomplete: prefix matches first, then by image count.
+
+        Queries of 3+ characters are substring matches through the tag_fts trigram index;
+        shorter ones (or a DB without FTS5) are prefix ranges on idx_tag_lower_name.
+        """
+        q = q.strip().lower().replace(' ', '_')
+        if not q:
+            return []
+
+        # user-created tags are listed even before they are applied to any image
+        where = '(tag.tag_count > 0 or tag.tag_id >= ?)'
+        params = [self.total_csv_tag_count]
+        if tag_type_id is not None:
+            where += ' and tag.tag_type_id = ?'
+            params.append(tag_type_id)
+
+        if len(q) >= 3 and self.has_tag_fts():
+            sql = f"""
+                select tag.tag_id, tag.tag_name, tag.tag_type_id, tag_type.tag_type_name, tag.tag_count
+                from tag_fts
+                    join tag on tag.pk = tag_fts.rowid
+                    join tag_type using(tag_type_id)
+                where tag_fts match ? and {where}
+                order by substr(lower(tag.tag_name), 1, ?) = ? desc, tag.tag_count desc, tag.tag_name
+                limit ?
+            """
+            # quoted as a single phrase so fts syntax characters in tag names are literal
+            params = ['"' + q.replace('"', '""') + '"'] + params + [len(q), q, limit]
+        else:
+            sql = f"""
+                select tag.tag_id, tag.tag_name, tag.tag_type_id, tag_type.tag_type_name, tag.tag_count
+                from tag join tag_type using(tag_type_id)
+                where lower(tag.tag_name) >= ? and lower(tag.tag_name) < ? and {where}
+                order by tag.tag_count desc, tag.tag_name
+                limit ?
+            """
+            params = [q, q[:-1] + chr(ord(q[-1]) + 1)] + params + [limit]
+
+        return self._run_query(sql, params=tuple(params))
 
     def get_top_tags(self, choice, tagtype):
         # Get the top 25 tags for a selected tag-class and sexiness
-        target = self.makeTarget(choice)        
-                
-        view = "tags_for_images_prob60_v2"
-        match tagtype:  # future support for other tagtype values, e.g. "artist"
-            case "C":
-                view = "char_tags_for_images_prob60_v2"
-        
-        sql_string = f"select tag_name, count(image_id) as imgcount, tag_id from {view} {target}"
-        sql_string += ''' group by 1
+        column = {'S': 's', 'X': 'x', 'Q': 'q', 'N': 'n'}.get(choice, 'g')
+        tag_type_id = TagType.character.value if tagtype == "C" else TagType.general.value
+
+        sql_string = f'''select tag.tag_name, tag_stats.{column} as imgcount, tag.tag_id
+                        from tag_stats join tag using(tag_id)
+                        where tag.tag_type_id = ? and tag_stats.{column} > 0
                         order by imgcount desc
                         limit 25'''
-        
-        results = self._run_query(sql_string)
+
+        results = self._run_query(sql_string, params=(tag_type_id,))
         return results
     
-    def makeTarget(self, choice):
-        # sensitivity sql logic, including none
-        target = "general";
-        match choice:
-            case "S":
-                target = "sensitive";
-            case "X":
-                target = "explicit";
-            case "Q":
-                target = "questionable"
-        res = "" if choice == "N" else f"where {target} >= 0.5 "
-        return res
-    
     def get_second_top_tags(self, choice, tagtype, primary, primaryType):
         # Get the top 25 *secondary* tags for a selected tag-name, tag-class and sexiness
-        
-        view = "tags_for_images_prob60_v2"
-        match tagtype:  # future support for other tagtype values, e.g. "artist"
-            case "C":
-                view = "char_tags_for_images_prob60_v2"
-        primview = "tags_for_images_prob60_v2"
-        match primaryType:  # future support for other tagtype values, e.g. "artist"
-            case "C":
-                primview = "char_tags_for_images_prob60_v2"
-        
-        sql = f"create temp view secondary_tags as select * from {view} where image_id in (select image_id from {primview} where tag_name='{primary}')"
-        self._run_query(sql, commit=True)
-        
-        target = self.makeTarget(choice)
-        
-        sql = f"select tag_name, count(image_id) as imgcount, tag_id from secondary_tags {target}"
-        sql += " where " if len(target) == 0 else " and " # if choice is 'N' we need a 'where', if not we need an 'and'
-        sql += f"tag_name != '{primary}'"  # avoid including the 'primary' tag
-        sql += " group by 1 order by imgcount desc limit 25"
-        results = self._run_query(sql)
-        self._run_query("drop view secondary_tags", commit=True)
+        column = {'S': 's', 'X': 'x', 'Q': 'q', 'N': 'n'}.get(choice, 'g')
+        tag_type_id = TagType.character.value if tagtype == "C" else TagType.general.value
+        primary_type_id = TagType.character.value if primaryType == "C" else TagType.general.value
+
+        sql = f'''select tag.tag_name, tag_pair_stats.{column} as imgcount, tag.tag_id
+                  from tag_pair_stats join tag on tag.tag_id = tag_pair_stats.other_tag_id
+                  where tag_pair_stats.tag_id = (select tag_id from tag where tag_name = ? and tag_type_id = ?)
+                    and tag.tag_type_id = ?
+                    and tag.tag_name != ?
+                    and tag_pair_stats.{column} > 0
+                  order by imgcount desc
+                  limit 25'''
+        results = self._run_query(sql, params=(primary, primary_type_id, tag_type_id, primary))
         return results
          
-    def get_common_tags(self, image_ids, tagtype, prob):
-        # get all the tags in common amongst a set of images.
-        # filter by tag type and probability
-        
-        sql = "";
-        count = len(image_ids)
-        curr = 1
-        # A separate select clause for each tag, with intersect for tags 2+
-        for imgid in image_ids:
-            # ignoring tag class
-            #sql += f"select t.tag_id, t.tag_name from tag t join image_tag it on t.tag_id=it.tag_id where it.image_id={imgid} and it.prob >={prob} and t.tag_type_id={tagtype}"
-            sql += f"select t.tag_id, t.tag_name, t.tag_type_id from tag t join image_tag it on t.tag_id=it.tag_id where it.image_id={imgid} and it.prob >={prob}"
-            if curr != count: # no extra intersect
-                sql += " INTERSECT "
-            curr += 1
-        sql += " order by tag_name asc"
-        
-        results = self._run_query(sql)
-        #blah = [row["tag_name"] for row in results] # list of tag names
+    def get_common_tags(self, image_ids, tagtype, prob, include_partial=False):
+        # get all the tags in common amongst a set of images, filtered by probability.
+        # image_count is the number of the images carrying the tag; with include_partial,
+        # tags present on only some of the images are returned as well.
+        # NOTE tag class is currently ignored
+        image_ids = list(set(image_ids))
+        if not image_ids:
+            return []
+
+        having = ''
+        params = image_ids + [prob]
+        if not include_partial:
+            having = 'having image_count = ?'
+            params.append(len(image_ids))
+
+        sql = f"""select t.tag_id, t.tag_name, t.tag_type_id, count(*) as image_count
+                  from image_tag it join tag t on t.tag_id = it.tag_id
+                  where it.image_id in ({get_placeholders(image_ids)}) and it.prob >= ?
+                  group by t.tag_id
+                  {having}
+                  order by t.tag_name asc"""
         
-        #print(f"gct: {blah}")
+        results = self._run_query(sql, params=params)
         return results
 
     def get_mra_tags(self):
@@ -499,78 +1157,79 @@ class ImageDb(SqliteDb):
         results = self._run_query(sql)
         return results
 
-    def delete_tags(self, image_ids, tags_to_delete):
-        # remove the given tags from the given images
-        for tag_id in tags_to_delete:
-            sql = f"delete from image_tag where tag_id={tag_id} and image_id in (" + ','.join(map(str, image_ids)) + ")"
-            self._run_query(sql, commit=True)
-        
-    def add_tags(self, image_ids, tags_to_add):
-        # add the given tags for the given images
-        
-        for image_id in image_ids:
-            for tag_id in tags_to_add:
-                sql = f"insert or ignore into image_tag (image_id, tag_id, prob) values ({image_id},{tag_id},1.0)" # NOTE probability set to 1.0 / absolute
-                self._run_query(sql, commit=True)
-                sql = f"insert or replace into mra_tags (tag_name, tag_id, updated_at) SELECT tag_name, tag_id, CURRENT_TIMESTAMP from tag where tag_id={tag_id}"
-                self._run_query(sql, commit=True)
-        
-    def add_possibly_new_tags(self, image_ids, tags_to_add, tagTypeId):
-        # This is a list of tags as strings, which may or may not exist. They are to be added to the specified images.
-        # TODO refactor with edit_tag
-        for tagText in tags_to_add:
-            sql = f"select tag_id from tag where tag_name like '{tagText}'" # like == case insensitive
-            results = self._run_query(sql)
-            if len(results) == 0:
-                sql = f"select max(tag_id) as new_id from tag"
-                results = self._run_query(sql)
-                new_id = int(results[0]["new_id"]) + 1
-                sql = f"insert or ignore into tag (tag_id, tag_name, tag_type_id, tag_count) values ({new_id}, '{tagText}', {tagTypeId}, 1)"
-                self._run_query(sql, commit=True)
-            else:
-                new_id = int(results[0]["tag_id"]) # TODO check for multiple results?
-                
-            # add to images with new_id
-            for image_id in image_ids:
-                sql = f"insert or ignore into image_tag (image_id, tag_id, prob) values ({image_id},{new_id},1.0)"
-                self._run_query(sql, commit=True)
-                
-            sql = f"insert or replace into mra_tags (tag_name, tag_id, updated_at) SELECT tag_name, tag_id, CURRENT_TIMESTAMP from tag where tag_id={new_id}"
-            self._run_query(sql, commit=True)
+    def apply_tag_changes(self, image_ids, tags_to_add, tags_to_delete, text_tags=(), text_tag_type_id=TagType.future.value) -> dict:
+        """Apply a tag diff to a set of images in a single transaction.
+
+        text_tags are tag names which may or may not exist yet; missing ones are created with
+        text_tag_type_id. tag.tag_count is kept current by the image_tag triggers.
+        Returns the number of image/tag pairs added and removed, and the number of tags created.
+        """
+        image_ids = list(set(image_ids))
+        tags_to_add = set(tags_to_add)
+        counts = {'added': 0, 'removed': 0, 'created_tags': 0}
+        if not image_ids:
+            return counts
 
-    def get_sha_dupls(self):
-        # return a list of image data for those image groups which have the same sha256 values
+        try:
+            for tag_text in set(text_tags):
+                rows = self.run_query_tuple('select tag_id from tag where lower(tag_name) = lower(?)', (tag_text,))
+                if rows:
+                    tag_id = int(rows[0][0]) # TODO check for multiple results?
+                else:
+                    tag_id = int(self.run_query_tuple('select max(tag_id) from tag')[0][0]) + 1
+                    self.run_query_tuple('insert into tag (tag_id, tag_name, tag_type_id) values (?, ?, ?)', (tag_id, tag_text, text_tag_type_id))
+                    counts['created_tags'] += 1
+                tags_to_add.add(tag_id)
+
+            if tags_to_delete:
+                counts['removed'] = self.run_write_many(
+                    'delete from image_tag where image_id = ? and tag_id = ?',
+                    [(image_id, tag_id) for tag_id in set(tags_to_delete) for image_id in image_ids]
+                )
+
+            if tags_to_add:
+                # NOTE probability set to 1.0 / absolute
+                counts['added'] = self.run_write_many(
+                    'insert or ignore into image_tag (image_id, tag_id, prob) values (?, ?, 1.0)',
+                    [(image_id, tag_id) for tag_id in tags_to_add for image_id in image_ids]
+                )
+                self.run_write_many(
+                    'insert or replace into mra_tags (tag_name, tag_id, updated_at) select tag_name, tag_id, CURRENT_TIMESTAMP from tag where tag_id = ?',
+                    [(tag_id,) for tag_id in tags_to_add]
+                )
+
+            self.bump_generation()
+            self.save()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+
+        return counts
+
+    def iter_sha_dupls(self):
+        # yield the image data for those image groups which have the same sha256 values, a group at a time
         
-        sql = '''SELECT A.image_id,A.sha256,A.directory_id,DIR.directory,A.filename,group_concat(t.tag_name) as tags
+        # walks idx_image_sha256 in order, with no GROUP BY or ORDER BY sort, so the first rows
+        # come back without the whole result being built first
+        sql = '''SELECT A.image_id,A.sha256,A.directory_id,DIR.directory,A.filename,
+                        (SELECT group_concat(t.tag_name) FROM image_tag it INNER JOIN tag t on t.tag_id = it.tag_id WHERE it.image_id = A.image_id) as tags
                  FROM image A
-                     INNER JOIN (SELECT
-                            sha256, COUNT(*) AS CountOf
-                            FROM image
-                            where sha256 is not null
-                            GROUP BY sha256
-                            HAVING COUNT(*)>1
-                        ) dt ON A.sha256=dt.sha256
                      INNER join directory DIR on A.directory_id = DIR.directory_id
-                     INNER JOIN image_tag it on A.image_id=it.image_id
-                     INNER JOIN tag t on t.tag_id = it.tag_id
-                     GROUP BY A.image_id
-                 ORDER BY A.sha256'''
-        results = self._run_query(sql)
-
-        #print(results)
-        
-        results2 = {}
-        i = 0
-        for item in results:
-            results2[i] = {
-                'image_id': item.image_id,
-                'image_path': os.path.join(item.directory, item.filename),
-                'sha256': item.sha256,
-                'tags': item.tags,
+                 WHERE A.sha256 is not null
+                     AND EXISTS (SELECT 1 FROM image B WHERE B.sha256 = A.sha256 AND B.image_id != A.image_id)
+                     AND EXISTS (SELECT 1 FROM image_tag it WHERE it.image_id = A.image_id)
+                 ORDER BY A.sha256, A.image_id'''
+        for image_id, sha256, directory_id, directory, filename, tags in self.iter_query(sql, dict_row=False):
+            yield {
+                'image_id': image_id,
+                'image_path': os.path.join(directory, filename),
+                'sha256': sha256,
+                'tags': tags,
             }
-            i += 1
-        #print(results2)
-        return results2
+
+
+    def get_sha_dupls(self) -> list[dict]:
+        return list(self.iter_sha_dupls())
 
     def remove_image(self, imageid):
         
@@ -578,7 +1237,8 @@ class ImageDb(SqliteDb):
         sql = f"delete from image_tag where image_id in ({imageid})"
         self._run_query(sql) # no commit, next query will do it for automicity
         sql = f"delete from image where image_id in ({imageid})"
-        self._run_query(sql, commit=True)
+        self._run_query(sql)
+        self.bump_generation(commit=True)
 
     def keep_tags(self, srcimage, dstimage):
         # replace the tags of the dstimage with the tags of the srcimage
@@ -586,44 +1246,45 @@ class ImageDb(SqliteDb):
         sql = f"delete from image_tag where image_id = {dstimage}"
         self._run_query(sql) # no commit, next query will do it for automicity
         sql = f"insert into image_tag (image_id, tag_id, prob) select {dstimage}, tag_id, prob from image_tag where image_id={srcimage}"
-        self._run_query(sql, commit=True)
-        
-    def clear_mark(self):
-        # clear the mark column in directory, image
-        sql = "update directory set mark = 0"
         self._run_query(sql)
-        sql = "update image set mark = 0"
-        self._run_query(sql, commit=True)
+        self.bump_generation(commit=True)
         
-    def mark_dir(self, dirp):
-        sql = f"update directory set mark = 1 where directory = '{dirp}' returning directory_id"
-        results = self._run_query(sql, commit=True)
-        return results
-
-    def mark_file(self, dirid, file):
-        sql = f"update image set mark = 1 where directory_id = ? and filename=?"
+    def get_directories(self) -> list[tuple]:
+        return self.run_query_tuple('select directory_id, directory from directory order by directory')
+
+    def get_directory_filenames(self, directory_id: int) -> dict[str, int]:
+        rows = self.run_query_tuple('select filename, image_id from image where directory_id = ?', (directory_id,))
+        return {row[0]: row[1] for row in rows}
+
+    def delete_images(self, image_ids: list[int]) -> int:
+        """Remove images and their tags in one transaction. Returns the number of images removed."""
+        if not image_ids:
+            return 0
+        params = [(image_id,) for image_id in image_ids]
         try:
-            self._run_query(sql, params=(dirid, file), commit=True)
-        except sqlite3.Error as e:
-            print(e)
-            print(f"{dirid}|{file}|")
-        
-    def mark_fileB(self, batch):
-        cur = self.conn.cursor()
-        sql = f"update image set mark = 1 where directory_id = ? and filename=?"
-        cur.executemany(sql, batch)
-        cur.close()
-        self.conn.commit()
-        #self._run_query(sql, params=batch, commit=True)
-        
-    def del_unmarked(self):
-        sql = "delete from image_tag where image_id in (select image_id from image where mark=0)"
-        self._run_query(sql)
-        sql = "delete from image where mark=0"
-        self._run_query(sql)
-        sql = "delete from directory where mark=0"
-        self._run_query(sql,commit=True)
-        
+            self.run_write_many('delete from image_tag where image_id = ?', params)
+            count = self.run_write_many('delete from image where image_id = ?', params)
+            self.bump_generation()
+            self.save()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+        return count
+
+    def delete_empty_directories(self, directory_ids: list[int]) -> int:
+        """Remove those of the given directories which no longer have any images or subdirectories.
+        Pass the deepest directories first so emptied parents go too."""
+        if not directory_ids:
+            return 0
+        count = self.run_write_many(
+            '''delete from directory where directory_id = ?
+                and not exists (select 1 from image where image.directory_id = directory.directory_id)
+                and not exists (select 1 from directory child where child.parent_id = directory.directory_id)''',
+            [(directory_id,) for directory_id in directory_ids],
+            commit=True
+        )
+        return count
+
     def get_image_path(self, imageid):
         #self.sql_echo = True
         results = self._run_query("select D.directory, I.filename from image I join directory D on I.directory_id = D.directory_id where I.image_id = ?", params=(imageid,));
@@ -631,87 +1292,68 @@ class ImageDb(SqliteDb):
         #self.sql_echo = False
         return results
         
+    def get_image_paths(self, image_ids: list[int]) -> dict[int, str]:
+        """Full path of each of the given images that exists in the db."""
+        paths = {}
+        for batch in batched(set(image_ids), 500):
+            sql = f'select image_id, directory, filename from image join directory using(directory_id) where image_id in ({get_placeholders(batch)})'
+            for image_id, directory, filename in self.run_query_tuple(sql, batch):
+                paths[image_id] = os.path.join(directory, filename)
+        return paths
+
     def get_letters_with_tags(self) -> list[dict]:
         sql = """
             SELECT DISTINCT lower(substr(tag_name, 1, 1)) as letter
             FROM tag
-            WHERE tag_count > 0
+            WHERE tag_count > 0 or tag_id >= ?
             ORDER BY letter
         """
-        return self._run_query(sql)
+        # user-created tags are listed even before they are applied to any image, as in get_tags
+        return self._run_query(sql, params=(self.total_csv_tag_count,))
 
     def get_tags_by_letter(self, letter: str) -> list[dict]:
         if not letter:
             return []
         if letter == '0':
-            sql = """
-                SELECT t.tag_id, t.tag_name, t.tag_count,
-                       it.image_id, d.directory || '/' || i.filename as image_path
-                FROM tag t
-                JOIN image_tag it ON t.tag_id = it.tag_id
-                JOIN image i ON i.image_id = it.image_id
-                JOIN directory d ON d.directory_id = i.directory_id
-                WHERE substr(t.tag_name, 1, 1) BETWEEN '0' AND '9' and t.tag_count > 0
-                GROUP BY t.tag_id
-                ORDER BY t.tag_name
-            """
-            return self._run_query(sql, params=())
+            where = "substr(t.tag_name, 1, 1) BETWEEN '0' AND '9'"
+            params = ()
         elif letter == '#':
-            sql = """
-                SELECT t.tag_id, t.tag_name, t.tag_count,
-                       it.image_id, d.directory || '/' || i.filename as image_path
-                FROM tag t
-                JOIN image_tag it ON t.tag_id = it.tag_id
-                JOIN image i ON i.image_id = it.image_id
-                JOIN directory d ON d.directory_id = i.directory_id
-                WHERE substr(t.tag_name, 1, 1) NOT BETWEEN '0' AND '9' 
-                and substr(lower(t.tag_name), 1, 1) NOT BETWEEN 'a' AND 'z' 
-                and t.tag_count > 0
-                GROUP BY t.tag_id
-                ORDER BY t.tag_name
-            """            
-            return self._run_query(sql, params=())
+            where = """substr(t.tag_name, 1, 1) NOT BETWEEN '0' AND '9'
+                and substr(lower(t.tag_name), 1, 1) NOT BETWEEN 'a' AND 'z'"""
+            params = ()
         else:
-            sql = """
-                SELECT t.tag_id, t.tag_name, t.tag_count,
-                       it.image_id, d.directory || '/' || i.filename as image_path
-                FROM tag t
-                JOIN image_tag it ON t.tag_id = it.tag_id
-                JOIN image i ON i.image_id = it.image_id
-                JOIN directory d ON d.directory_id = i.directory_id
-                WHERE lower(t.tag_name) LIKE ? AND t.tag_count > 0
-                GROUP BY t.tag_id
-                ORDER BY t.tag_name
-            """
-            return self._run_query(sql, params=(letter[0].lower() + '%',))
+            where = 'lower(t.tag_name) >= ? and lower(t.tag_name) < ?'
+            params = (letter[0].lower(), chr(ord(letter[0].lower()) + 1))
+
+        # tag_rep_image is picked by refresh_tag_rep_images, and the insert trigger fills in tags tagged since
+        sql = f"""
+            SELECT t.tag_id, t.tag_name, t.tag_count,
+                   r.image_id, d.directory || '/' || i.filename as image_path
+            FROM tag t
+            LEFT JOIN tag_rep_image r ON r.tag_id = t.tag_id
+            LEFT JOIN image i ON i.image_id = r.image_id
+            LEFT JOIN directory d ON d.directory_id = i.directory_id
+            WHERE {where} and (t.tag_count > 0 or t.tag_id >= ?)
+            ORDER BY t.tag_name
+        """
+        return self._run_query(sql, params=(*params, self.total_csv_tag_count))
 
     def get_cloud_tags(self, choice, tagtype):
         
-        target = "general";
-        match choice:
-            case "S":
-                target = "sensitive";
-            case "X":
-                target = "explicit";
-            case "Q":
-                target = "questionable"
-                
-        view = "tags_for_images_prob60_v2"
-        match tagtype:  # future support for other tagtype values, e.g. "artist"
-            case "C":
-                view = "char_tags_for_images_prob60_v2"
-        
-        sql_string = f"select tag_name, count(image_id) as imgcount, tag_id from {view} where {target}"
-        sql_string += ''' >= 0.6
-                        group by 1
+        column = {'S': 'cloud_s', 'X': 'cloud_x', 'Q': 'cloud_q'}.get(choice, 'cloud_g')
+        tag_type_id = TagType.character.value if tagtype == "C" else TagType.general.value
+
+        sql_string = f'''select tag.tag_name, tag_stats.{column} as imgcount, tag.tag_id
+                        from tag_stats join tag using(tag_id)
+                        where tag.tag_type_id = ? and tag_stats.{column} > 0
                         order by imgcount desc
                         limit 100'''
-        
-        results = self._run_query(sql_string)
-        
-        sql_string = f"select count(DISTINCT image_id) as tcount from {view} where {target} >= 0.6";
-        results2 = self._run_query(sql_string)
-        cnt = int(results2[0]["tcount"])
+
+        results = self._run_query(sql_string, params=(tag_type_id,))
+        if not results:
+            return []
+
+        # sizes are relative to the most common tag
         cnt = int(results[0]["imgcount"])
         
         outres = []
@@ -719,73 +1361,22 @@ class ImageDb(SqliteDb):
             outres.append( ( res['tag_name'], res['tag_id'], int(res['imgcount']) / cnt ) )
         return outres
     
-    def get_random_images_by_tag_ids(self, rand_state, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, page: int, per_page: int) -> list[dict]:
+    def get_random_images_by_tag_ids(self, seed, tag_ids: list[int], f_tag: float, f_general: float, f_sensitive: float, f_explicit: float, f_questionable: float, page: int, per_page: int, folder: str=None, meta: tuple[tuple[str, str], ...]=None) -> list[dict]:
+        """A page of the matching images in a random order fixed by `seed`; pass seed=None to pick a new order."""
+        if seed is None:
+            seed = random.randrange(1, 2**31)
 
-        randstateOut = None
-        if rand_state is None:
-            random.seed()
-            randstateOut = random.getstate()
-        else:
-            random.setstate(rand_state)
-            randstateOut = rand_state
-        
-        if tag_ids is None or len(tag_ids) == 0:
-            imgids = self.run_query_tuple(f"""
-                select image_tag.image_id
-                from image join image_tag using(image_id)
-                           join directory using(directory_id)
-                where
-                    general >= ?
-                    and sensitive >= ?
-                    and questionable >= ?
-                    and explicit >= ?
-                group by image_tag.image_id""",
-            params=[f_general, f_sensitive, f_questionable, f_explicit])
-        else:
-            imgids = self.run_query_tuple(f"""
-                select image_tag.image_id
-                from image join image_tag using(image_id)
-                           join directory using(directory_id)
-                where
-                    image_tag.tag_id in ({get_placeholders(tag_ids)})
-                    and image_tag.prob >= ?
-                    and general >= ?
-                    and sensitive >= ?
-                    and questionable >= ?
-                    and explicit >= ?
-                group by image_tag.image_id
-                having count(distinct image_tag.tag_id) = ?""",
-            params=tag_ids + [f_tag, f_general, f_sensitive, f_questionable, f_explicit, len(tag_ids)])
-            
-        if not imgids:
-            return [], 0, randstateOut
-            
-        image_ids = [row[0] for row in imgids]
+        image_ids = self._search_image_ids(tag_ids or [], f_tag, f_general, f_sensitive, f_explicit, f_questionable, folder, meta)
         imgmax = len(image_ids)
-        
-        # we've reset the rand gen, so skip past those images from earlier pages
-        skips = []
-        skip = (page - 1 ) * per_page
-        if (page != 1):        
-            while len(skips) < skip:
-                who = random.randint(0, imgmax-1)
-                if (image_ids[who] not in skips):
-                    skips.append( image_ids[who] )
-        
-        thispagelen = imgmax - skip
-        targetlen = thispagelen if thispagelen < per_page else per_page
-        targets = []
-        # random may get a duplicate id, or be out of range
-        while len(targets) < targetlen:    
-            try:
-                who = random.randint(0, imgmax-1)
-                if (image_ids[who] not in targets and image_ids[who] not in skips):
-                    targets.append( image_ids[who] )
-            except:
-                print(f"GRIBT except: {who} {imgmax}")
+        if not imgmax:
+            return [], 0, seed
+
+        # each page is computed directly from the permutation, no need to replay earlier pages
+        start = max(page - 1, 0) * per_page
+        targets = [image_ids[permuted_index(i, imgmax, seed)] for i in range(start, min(start + per_page, imgmax))]
 
         results = self._fetch_results(targets)
-        return results,imgmax,randstateOut
+        return results,imgmax,seed
         
     def edit_tag(self, tag_id, tag_name, tag_class):
         if len(tag_name.strip()) == 0 or len(tag_class.strip()) == 0:
@@ -797,7 +1388,7 @@ class ImageDb(SqliteDb):
         ttid = res[0]["tag_type_id"]
         
         if int(tag_id) == -1: # creating new tag
-            # TODO refactor with add_possibly_new_tags
+            # TODO refactor with apply_tag_changes
             sql = f"select tag_id from tag where tag_name like '{tag_name}'" # like == case insensitive
             results = self._run_query(sql)
             if len(results) != 0:
@@ -806,12 +1397,13 @@ class ImageDb(SqliteDb):
             sql = 'select max(tag_id) from tag'
             results = self._run_query(sql)
             tagid = list(results[0].values())[0] + 1
-            # TODO setting tag_count to 1 because otherwise tag doesn't appear in GUI [see get_tags]. Need to reconsider?
-            sql = f'insert into tag (tag_id, tag_name, tag_type_id, tag_count) values ({tagid}, "{tag_name}", {ttid}, 1)'
+            sql = f'insert into tag (tag_id, tag_name, tag_type_id) values ({tagid}, "{tag_name}", {ttid})'
             self._run_query(sql)
+            self.bump_generation(commit=True)
         else:
             self._run_query(f"update tag set tag_name='{tag_name}', tag_type_id={ttid} where tag_id={tag_id}")
             self._run_query(f"update mra_tags set tag_name='{tag_name}' where tag_id={tag_id}")
+            self.bump_generation()
             self.save()
         return []
 
@@ -822,5 +1414,6 @@ class ImageDb(SqliteDb):
         self._run_query(sql)
         sql = f"delete from tag where tag_id={tag_id}"
         self._run_query(sql)
+        self.bump_generation()
         self.save()
         return []
@@ -1,43 +1,38 @@
 # Using configs.toml, removes all image references where the physical file
 # doesn't exist.
+#
+# Usage: python db_cleanup.py [--dry-run]
 
-import os
+import sys
 from configs import TaggerConfigs, configs
 from db import ImageDb
+from fs_verify import FsVerifier
+from utils import printr
 
 class DbCleanup:
     def __init__(self, configs: TaggerConfigs):
         self.configs: TaggerConfigs = configs
 
-        self.db: ImageDb = ImageDb(self.configs.db_path, self.configs.sql_echo)
+        self.db: ImageDb = ImageDb(self.configs.db_path, self.configs.sql_echo, wal=self.configs.sqlite_wal,
+            busy_timeout=self.configs.sqlite_busy_timeout, wal_autocheckpoint=self.configs.sqlite_wal_autocheckpoint)
 
-    def run_cleanup(self):
+    def run_cleanup(self, dry_run: bool=False):
 
-        sql = f"""
-        select
-            directory_id, directory, filename, image_id
-        from image
-            join directory using (directory_id)
-        """
+        verifier = FsVerifier(
+            self.db,
+            workers=self.configs.verify_workers,
+            batch_size=self.configs.sql_insert_batch_size,
+            progress=lambda done, total: printr(f'Directories: {done:,}/{total:,}'),
+        )
+        report = verifier.run(dry_run=dry_run, root_path=self.configs.root_path)
+        print()
 
-        results = self.db._run_query(sql)
-        print(f"count: {len(results)}")
-        
-        # ?do this by pages using LIMIT and OFFSET
-
-        for result in results:
-          fullpath = os.path.join(result['directory'], result['filename'])
-          if not os.path.exists(fullpath):
-            print(f"Missing! {result['image_id']}:{fullpath}")
-            self.db._run_query("delete from image_tag where image_id=?", (result['image_id'],))
-            self.db._run_query("delete from image where image_id=?", (result['image_id'],),commit=True)
-
-        # TODO tag.tag_count is now inaccurate            
-        
-        # TODO should there be a delete trigger on image.image_id ?
+        for image_id, path in report.missing_images:
+            print(f"Missing! {image_id}:{path}")
+        print(report.summary())
 
         # TODO can the database be compacted?
         
 if __name__ == '__main__':
     util = DbCleanup(configs)
-    util.run_cleanup()
+    util.run_cleanup(dry_run='--dry-run' in sys.argv[1:])
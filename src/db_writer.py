@@ -0,0 +1,152 @@
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+
+from db import ImageDb
+
+
+class WriterImageDb(ImageDb):
+    """ImageDb on the writer thread's connection.
+
+    While a batch is open, save() and rollback() do nothing: DbWriter commits the batch as a whole
+    and undoes a failed job by rolling back to that job's savepoint.
+    """
+    def __init__(self, db_path, sql_echo=False, wal=False, busy_timeout=5.0, wal_autocheckpoint=1000):
+        super().__init__(db_path, sql_echo, wal=wal, busy_timeout=busy_timeout, wal_autocheckpoint=wal_autocheckpoint)
+        self.in_batch = False
+
+
+    def save(self):
+        if not self.in_batch:
+            super().save()
+
+
+    def rollback(self):
+        if not self.in_batch:
+            super().rollback()
+
+
+class DbWriter:
+    """A thread which owns the only connection used for web-originated writes.
+
+    Jobs are callables taking the WriterImageDb as their first argument, e.g.
+    `writer.call(ImageDb.remove_image, image_ids)`. Jobs queued back to back are run in a single
+    transaction, each in its own savepoint, so one failing job doesn't undo the others.
+    """
+    def __init__(self, db: WriterImageDb, max_batch: int=100):
+        self.db = db
+        self.max_batch = max_batch
+
+        self.jobs = 0
+        self.errors = 0
+        self.batches = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.last_batch_size = 0
+
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+
+    def call(self, fn, *args, **kwargs):
+        """submit() and wait for the result; exceptions raised by the job are re-raised here."""
+        return self.submit(fn, *args, **kwargs).result()
+
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.db.close()
+
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._queue.put(None) # finish this batch first
+                    break
+                batch.append(job)
+
+            self._run_batch([job for job in batch if job[0].set_running_or_notify_cancel()])
+
+
+    def _run_batch(self, batch: list):
+        if not batch:
+            return
+
+        conn = self.db._get_conn()
+        results = []
+        start = perf_counter()
+        try:
+            conn.execute('begin immediate')
+        except sqlite3.Error as e:
+            for future, *_ in batch:
+                future.set_exception(e)
+            return
+
+        self.db.in_batch = True
+        try:
+            for i, (future, fn, args, kwargs) in enumerate(batch):
+                conn.execute(f'savepoint job{i}')
+                try:
+                    results.append((future, True, fn(self.db, *args, **kwargs)))
+                    conn.execute(f'release job{i}')
+                except Exception as e:
+                    conn.execute(f'rollback to job{i}')
+                    conn.execute(f'release job{i}')
+                    results.append((future, False, e))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            results = [(future, False, e) for future, *_ in batch]
+        finally:
+            self.db.in_batch = False
+
+        elapsed = perf_counter() - start
+        with self._lock:
+            self.batches += 1
+            self.jobs += len(batch)
+            self.errors += sum(1 for _, ok, _ in results if not ok)
+            self.commit_seconds += elapsed
+            self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+            self.last_batch_size = len(batch)
+
+        # only now are the changes visible to readers
+        for future, ok, value in results:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'jobs': self.jobs,
+                'errors': self.errors,
+                'batches': self.batches,
+                'jobs_per_batch': round(self.jobs / self.batches, 2) if self.batches else 0.0,
+                'last_batch_size': self.last_batch_size,
+                'avg_commit_ms': round(1000 * self.commit_seconds / self.batches, 3) if self.batches else 0.0,
+                'max_commit_ms': round(1000 * self.max_commit_seconds, 3),
+            }
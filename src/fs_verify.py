@@ -0,0 +1,124 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from time import perf_counter
+
+from db import ImageDb
+
+
+@dataclass
+class VerifyReport:
+    dry_run: bool = False
+    directories: int = 0
+    images: int = 0
+    missing_directories: list[str] = field(default_factory=list)
+    missing_images: list[tuple[int, str]] = field(default_factory=list) # (image_id, path)
+    unreadable_directories: list[str] = field(default_factory=list)
+    deleted_images: int = 0
+    deleted_directories: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def images_per_second(self) -> float:
+        return self.images / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        action = 'would remove' if self.dry_run else 'removed'
+        count = len(self.missing_images) if self.dry_run else self.deleted_images
+        return '\n'.join([
+            f'Checked {self.images:,} images in {self.directories:,} directories in {self.elapsed:.3f}s ({self.images_per_second:,.0f} images/s).',
+            f'Missing: {len(self.missing_images):,} images, {len(self.missing_directories):,} directories, {action} {count:,} images.',
+            f'Unreadable directories, skipped: {len(self.unreadable_directories):,}',
+        ])
+
+
+def list_directory(directory: str) -> set[str]:
+    """Names in a directory, or None if the directory no longer exists."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+class FsVerifier:
+    """Finds images in the database whose files are gone, and removes them.
+
+    Each directory is listed once with os.scandir, on a thread pool, and compared against the
+    filenames the database holds for it. All database access stays on the calling thread, or
+    for deletes goes through `writer` (a DbWriter) if one is given.
+    """
+    def __init__(self, db: ImageDb, workers: int=8, batch_size: int=10_000, progress=None, writer=None):
+        self.db = db
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress = progress # called with (directories done, total directories)
+        self.writer = writer
+
+
+    def _write(self, fn, *args):
+        if self.writer:
+            return self.writer.call(fn, *args)
+        return fn(self.db, *args)
+
+
+    def run(self, dry_run: bool=False, root_path: str=None) -> VerifyReport:
+        # an unmounted share looks exactly like every image having been deleted
+        if root_path and not os.path.isdir(root_path):
+            raise FileNotFoundError(f'Root path is not available: {root_path}')
+
+        report = VerifyReport(dry_run=dry_run)
+        start = perf_counter()
+
+        directories = self.db.get_directories()
+        missing_directory_ids = []
+        batch = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(list_directory, directory): (directory_id, directory) for directory_id, directory in directories}
+            try:
+                for future in as_completed(futures):
+                    directory_id, directory = futures.pop(future)
+                    report.directories += 1
+
+                    try:
+                        names = future.result()
+                    except OSError as e:
+                        print(f'Unable to read {directory}: {e}')
+                        report.unreadable_directories.append(directory)
+                        continue
+
+                    filenames = self.db.get_directory_filenames(directory_id)
+                    report.images += len(filenames)
+
+                    if names is None:
+                        report.missing_directories.append(directory)
+                        missing_directory_ids.append((directory_id, directory))
+                        missing = filenames.keys()
+                    else:
+                        missing = filenames.keys() - names
+
+                    for filename in missing:
+                        report.missing_images.append((filenames[filename], os.path.join(directory, filename)))
+                        batch.append(filenames[filename])
+
+                    if not dry_run and len(batch) >= self.batch_size:
+                        report.deleted_images += self._write(ImageDb.delete_images, batch)
+                        batch = []
+
+                    if self.progress:
+                        self.progress(report.directories, len(directories))
+            except BaseException:
+                # e.g. JobCancelled from progress(): drop the directories not yet listed rather
+                # than waiting for the whole library to be scanned; only running listings finish
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        if not dry_run:
+            report.deleted_images += self._write(ImageDb.delete_images, batch)
+            # deepest first, so a missing parent is removed after its missing subdirectories
+            missing_directory_ids.sort(key=lambda missing: len(missing[1]), reverse=True)
+            report.deleted_directories = self._write(ImageDb.delete_empty_directories, [directory_id for directory_id, _ in missing_directory_ids])
+
+        report.elapsed = perf_counter() - start
+        return report
@@ -0,0 +1,126 @@
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+
+from PIL import Image
+
+from processor import process_images_from_imgs
+from tagger import Tagger
+
+
+class InferenceService:
+    """A thread which owns the tagging model and runs uploads through it in batches.
+
+    The first queued image starts a batch, which then waits up to `max_wait_ms` for more,
+    up to `max_batch` images. Each future resolves to (rating_tags, char_tags, gen_tags, timings),
+    the tags keyed by tag index as with process_images_from_imgs(by_idx=True).
+    """
+    def __init__(self, tagger: Tagger, min_general_tag_val: float, min_character_tag_val: float, max_batch: int=8, max_wait_ms: float=10.0):
+        self.tagger = tagger
+        self.min_general_tag_val = min_general_tag_val
+        self.min_character_tag_val = min_character_tag_val
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.queue_seconds = 0.0
+        self.inference_seconds = 0.0
+        self.max_batch_seen = 0
+
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='inference', daemon=True)
+        self._thread.start()
+
+
+    def submit(self, img: Image.Image) -> Future:
+        """`img` should already be decoded, e.g. with img.load(), so a bad upload fails its own request and not the batch."""
+        future = Future()
+        self._queue.put((future, img, perf_counter()))
+        return future
+
+
+    def tag(self, img: Image.Image) -> tuple[dict, dict, dict, dict]:
+        return self.submit(img).result()
+
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            batch = [job]
+            deadline = job[2] + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get(timeout=max(0.0, deadline - perf_counter()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._queue.put(None) # finish this batch first
+                    break
+                batch.append(job)
+
+            self._run_batch([job for job in batch if job[0].set_running_or_notify_cancel()])
+
+
+    def _run_batch(self, batch: list):
+        if not batch:
+            return
+
+        start = perf_counter()
+        try:
+            outputs = process_images_from_imgs(
+                [img for _, img, _ in batch],
+                self.tagger.model,
+                self.tagger.transform,
+                self.tagger.torch_device,
+                self.tagger.tag_data,
+                self.min_general_tag_val,
+                self.min_character_tag_val,
+                by_idx=True,
+            )
+        except Exception as e:
+            with self._lock:
+                self.errors += len(batch)
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        elapsed = perf_counter() - start
+
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.queue_seconds += sum(start - queued for _, _, queued in batch)
+            self.inference_seconds += elapsed
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+        for (future, _, queued), (rating_tags, char_tags, gen_tags) in zip(batch, outputs):
+            future.set_result((rating_tags, char_tags, gen_tags, {
+                'queue_ms': round(1000 * (start - queued), 3),
+                'batch_size': len(batch),
+                'inference_ms': round(1000 * elapsed, 3),
+            }))
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'requests_per_batch': round(self.requests / self.batches, 2) if self.batches else 0.0,
+                'max_batch_size': self.max_batch_seen,
+                'avg_queue_ms': round(1000 * self.queue_seconds / self.requests, 3) if self.requests else 0.0,
+                'avg_inference_ms': round(1000 * self.inference_seconds / self.batches, 3) if self.batches else 0.0,
+            }
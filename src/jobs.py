@@ -0,0 +1,160 @@
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """A background task's progress, shared between the worker running it and anyone watching.
+
+    The task calls progress() as it goes and raise_if_cancelled() wherever stopping is safe;
+    cancel() only asks. Watchers call wait() to sleep until something changes.
+    """
+    def __init__(self, job_id: int, name: str):
+        self.id = job_id
+        self.name = name
+        self.state = 'queued' # running, done, failed, cancelled
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+
+        self.queued_at = monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+        self.version = 0
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('done', 'failed', 'cancelled')
+
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+
+    def _update(self, **attrs):
+        with self._changed:
+            for attr, value in attrs.items():
+                setattr(self, attr, value)
+            self.version += 1
+            self._changed.notify_all()
+
+
+    def progress(self, done: int, total: int=None):
+        self._update(done=done, total=self.total if total is None else total)
+
+
+    def cancel(self):
+        self._cancel.set()
+        if self.state == 'queued':
+            self._update(state='cancelled', finished_at=monotonic())
+        else:
+            self._update() # wake watchers so they see the request
+
+
+    def raise_if_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Block until the job changes from `version`, or `timeout` seconds pass. Returns the current version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+    def snapshot(self) -> dict:
+        with self._changed:
+            now = monotonic()
+            elapsed = ((self.finished_at or now) - self.started_at) if self.started_at else 0.0
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            remaining = max(self.total - self.done, 0)
+            return {
+                'id': self.id,
+                'name': self.name,
+                'state': self.state,
+                'cancel_requested': self._cancel.is_set(),
+                'done': self.done,
+                'total': self.total,
+                'percent': int(100 * self.done / self.total) if self.total else (100 if self.state == 'done' else 0),
+                'elapsed_s': round(elapsed, 3),
+                'per_second': round(rate, 3),
+                'eta_s': round(remaining / rate, 1) if rate and not self.finished else None,
+                'result': self.result,
+                'error': self.error,
+                'version': self.version,
+            }
+
+
+class JobManager:
+    """Runs jobs on at most `max_workers` threads; the rest wait their turn.
+
+    A job is fn(job, *args, **kwargs). Its return value becomes the job's result; raising
+    JobCancelled marks it cancelled. The last `keep_finished` finished jobs stay visible.
+    """
+    def __init__(self, max_workers: int=2, keep_finished: int=50):
+        self.keep_finished = keep_finished
+
+        self._jobs: OrderedDict[int, Job] = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+
+
+    def submit(self, name: str, fn, *args, **kwargs) -> Job:
+        with self._lock:
+            job = Job(next(self._ids), name)
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+
+    def _run(self, job: Job, fn, args, kwargs):
+        if job.finished: # cancelled while queued
+            return
+        job._update(state='running', started_at=monotonic())
+        try:
+            result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            job._update(state='cancelled', finished_at=monotonic())
+        except Exception as e:
+            print(f'Job {job.id} {job.name} failed: {e!r}')
+            job._update(state='failed', error=str(e), finished_at=monotonic())
+        else:
+            job._update(state='done', result=result, finished_at=monotonic())
+
+
+    def _prune(self):
+        # called with the lock held
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self._jobs[job_id]
+
+
+    def get(self, job_id: int) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+
+    def shutdown(self):
+        for job in self.jobs():
+            job.cancel()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,167 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+
+import exiftool
+from exiftool.exceptions import ExifToolExecuteError
+
+from db import ImageDb
+from utils import printr
+
+
+class ExifToolPool:
+    """Long-lived exiftool processes (-stay_open), started as needed up to `size`.
+
+    Each process serves one thread at a time; callers wait for a free one. A process
+    left in an unknown state by an error is terminated and replaced on the next call.
+    """
+    def __init__(self, size: int=2, common_args: list[str]=None):
+        self.size = size
+        self.common_args = common_args
+
+        self.calls = 0
+        self.errors = 0
+        self.restarts = 0
+
+        self._started = 0
+        self._idle: list[exiftool.ExifToolHelper] = [] # most recently used last, the rest can idle
+        self._changed = threading.Condition() # a process was returned, or a slot freed up
+
+
+    def _acquire(self) -> exiftool.ExifToolHelper:
+        with self._changed:
+            while not self._idle and self._started >= self.size:
+                self._changed.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+
+        et = exiftool.ExifToolHelper(common_args=self.common_args)
+        try:
+            et.run()
+        except Exception:
+            self._free_slot()
+            raise
+        return et
+
+
+    def _release(self, et: exiftool.ExifToolHelper):
+        with self._changed:
+            self._idle.append(et)
+            self._changed.notify()
+
+
+    def _free_slot(self):
+        # a waiter can start a process in its place
+        with self._changed:
+            self._started -= 1
+            self._changed.notify()
+
+
+    def _discard(self, et: exiftool.ExifToolHelper):
+        try:
+            et.terminate()
+        except Exception:
+            pass
+        self._free_slot()
+        with self._changed:
+            self.restarts += 1
+
+
+    def get_metadata(self, paths: list[str]) -> list[dict]:
+        """One dict per path, in order, as from ExifToolHelper.get_metadata."""
+        et = self._acquire()
+        try:
+            metadata = et.get_metadata(paths)
+        except ExifToolExecuteError:
+            # exiftool reported a bad file; the process itself is fine
+            self._release(et)
+            with self._changed:
+                self.errors += 1
+            raise
+        except Exception:
+            self._discard(et)
+            with self._changed:
+                self.errors += 1
+            raise
+
+        self._release(et)
+        with self._changed:
+            self.calls += 1
+        return metadata
+
+
+    def close(self):
+        with self._changed:
+            idle, self._idle = self._idle, []
+        for et in idle:
+            et.terminate()
+            self._free_slot()
+
+
+    def stats(self) -> dict:
+        with self._changed:
+            return {
+                'size': self.size,
+                'started': self._started,
+                'idle': len(self._idle),
+                'calls': self.calls,
+                'errors': self.errors,
+                'restarts': self.restarts,
+            }
+
+
+def read_metadata(pool: ExifToolPool, paths: list[str]) -> list[dict | None]:
+    """Metadata for each path, None where exiftool couldn't read the file."""
+    try:
+        return pool.get_metadata(paths)
+    except (ExifToolExecuteError, OSError) as e:
+        if len(paths) == 1:
+            print(f'Metadata failed for {paths[0]}: {e}')
+            return [None]
+    # one bad file fails the whole call; find it by asking for each file on its own
+    return [meta for path in paths for meta in read_metadata(pool, [path])]
+
+
+def ingest_image_meta(db: ImageDb, pool: ExifToolPool, fields: tuple[str, ...], batch_size: int=100) -> int:
+    """Read and store the metadata of every image that has none stored yet. Returns the number of images stored.
+
+    Batches are read on all of the pool's processes at once and written from this thread, with
+    only a few batches read ahead of the writes. Files which are missing or can't be read are skipped.
+    """
+    total = db.count_images_without_meta()
+    print(f'Reading metadata for {total} images')
+
+    def read(batch: tuple) -> list[tuple]:
+        stats = []
+        for image_id, path in batch:
+            try:
+                stats.append((image_id, path, os.stat(path).st_mtime_ns))
+            except OSError as e:
+                print(f'Metadata skipped for {path}: {e}')
+        metas = read_metadata(pool, [path for _, path, _ in stats]) if stats else []
+        return [(image_id, mtime_ns, meta) for (image_id, _, mtime_ns), meta in zip(stats, metas) if meta is not None]
+
+    count = 0
+    done = 0
+    in_flight = deque()
+
+    def store():
+        nonlocal count, done
+        batch, future = in_flight.popleft()
+        done += len(batch)
+        count += db.save_image_meta(future.result(), fields)
+        db.save()
+        printr(f'Metadata: {min(done, total)}/{total}  Stored: {count}')
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        for batch in batched(db.iter_images_without_meta(), batch_size):
+            in_flight.append((batch, executor.submit(read, batch)))
+            if len(in_flight) >= 2 * pool.size:
+                store()
+        while in_flight:
+            store()
+    print()
+    return count
@@ -1,4 +1,4 @@
-from typing import Iterable
+from typing import Callable, Iterable
 
 import torch
 from PIL import Image
@@ -36,13 +36,16 @@ def get_tags(probs: Tensor, tag_data: TagData, g_min: float, c_min: float, by_id
     return rating_tags, char_tags, gen_tags
 
 
-def process_images_from_paths(image_paths: Iterable[str], model: nn.Module, transform: Compose, torch_device: device, tag_data: TagData, g_min: float, c_min: float, by_idx: bool=True):
+def process_images_from_paths(image_paths: Iterable[str], model: nn.Module, transform: Compose, torch_device: device, tag_data: TagData, g_min: float, c_min: float, by_idx: bool=True, on_image: Callable[[str, Image.Image], None]=None):
+    """`on_image(path, img)` is called with each opened image, e.g. to write its thumbnail without decoding it twice."""
 
     Image.MAX_IMAGE_PIXELS = None # support larger images
 
     img_tensors = []
     for image_path in image_paths:
         img = Image.open(image_path)
+        if on_image:
+            on_image(image_path, img)
         img = pil_ensure_rgb(img)
         img_tensor = transform(img).unsqueeze(0).to(torch_device, non_blocking=True)[:, [2, 1, 0]]  # RGB to BGR
         img_tensors.append(img_tensor)
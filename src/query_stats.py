@@ -0,0 +1,116 @@
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+
+
+def calling_method(skip_files: tuple[str, ...]) -> str:
+    """Qualified name of the nearest caller outside `skip_files`, e.g. 'ImageDb.get_top_tags'."""
+    frame = sys._getframe(1)
+    while frame and frame.f_code.co_filename.endswith(skip_files):
+        frame = frame.f_back
+    return frame.f_code.co_qualname if frame else '?'
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+class _Timings:
+    def __init__(self, max_samples: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=max_samples) # the most recent timings, for percentiles
+
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total_ms': round(1000 * self.total, 3),
+            'avg_ms': round(1000 * self.total / self.count, 3) if self.count else 0.0,
+            'p50_ms': round(1000 * percentile(samples, 0.50), 3),
+            'p95_ms': round(1000 * percentile(samples, 0.95), 3),
+            'p99_ms': round(1000 * percentile(samples, 0.99), 3),
+            'max_ms': round(1000 * self.max, 3),
+        }
+
+
+class QueryStats:
+    """Query timings grouped by the ImageDb method (and web endpoint) that ran them,
+    plus a log of the most recent queries slower than `slow_ms` with their query plans.
+
+    Percentiles are over the last `max_samples` queries of each method or endpoint.
+    """
+    def __init__(self, slow_ms: float=250.0, max_samples: int=1_000, max_slow: int=100):
+        self.slow_ms = slow_ms
+        self.max_samples = max_samples
+        self.slow = deque(maxlen=max_slow)
+
+        self._methods: dict[str, _Timings] = {}
+        self._endpoints: dict[str, _Timings] = {}
+        self._lock = threading.Lock()
+
+
+    def is_slow(self, seconds: float) -> bool:
+        return 1000 * seconds >= self.slow_ms
+
+
+    def record(self, method: str, seconds: float, endpoint: str=None):
+        with self._lock:
+            if method not in self._methods:
+                self._methods[method] = _Timings(self.max_samples)
+            self._methods[method].add(seconds)
+
+            if endpoint:
+                if endpoint not in self._endpoints:
+                    self._endpoints[endpoint] = _Timings(self.max_samples)
+                self._endpoints[endpoint].add(seconds)
+
+
+    def record_slow(self, method: str, seconds: float, sql: str, params, plan: list[str], endpoint: str=None):
+        sql = ' '.join(sql.split())
+        print(f'Slow query, {1000 * seconds:.1f}ms in {method}{f" for {endpoint}" if endpoint else ""}: {sql[:200]}')
+        with self._lock:
+            self.slow.append({
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'method': method,
+                'endpoint': endpoint,
+                'ms': round(1000 * seconds, 3),
+                'sql': sql,
+                'params': params if isinstance(params, str) else repr(params)[:500],
+                'plan': plan,
+            })
+
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._endpoints.clear()
+            self.slow.clear()
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            methods = [{'name': method, **timings.summary()} for method, timings in self._methods.items()]
+            endpoints = [{'name': endpoint, **timings.summary()} for endpoint, timings in self._endpoints.items()]
+            slow = list(self.slow)
+
+        # lists rather than dicts keep the order through jsonify
+        by_p99 = lambda row: row['p99_ms']
+        return {
+            'slow_ms': self.slow_ms,
+            'methods': sorted(methods, key=by_p99, reverse=True),
+            'endpoints': sorted(endpoints, key=by_p99, reverse=True),
+            'slow': slow[::-1], # newest first
+        }
@@ -1,4 +1,7 @@
 import sqlite3
+from time import perf_counter
+
+from query_stats import calling_method
 
 
 def get_placeholders(l: list) -> str:
@@ -13,21 +16,66 @@ class DotDict(dict):
     __delattr__ = dict.__delitem__
 
 
+# (cursor.description, column names) of the last query seen by row_factory. A cursor keeps the
+# same description object for all rows of a query, so the names are only built once per query.
+_column_keys = (None, None)
+
+
 def row_factory(cursor, row: tuple):
-    keys = [col[0] for col in cursor.description]
+    global _column_keys
+    description, keys = _column_keys
+    if description is not cursor.description:
+        description = cursor.description
+        keys = tuple(col[0] for col in description)
+        _column_keys = (description, keys)
     return DotDict(zip(keys, row))
 
 
 class SqliteDb:
-    def __init__(self, db_path: str, sql_echo=False):
+    def __init__(self, db_path: str, sql_echo=False, wal=False, busy_timeout=5.0, wal_autocheckpoint=1000):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False) # HACK
-        self.conn.row_factory = row_factory
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.conn = self._connect()
         self.sql_echo = sql_echo
 
+        # optional QueryStats, see query_stats.py
+        self.query_stats = None
+
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, check_same_thread=False) # HACK
+        if self.wal:
+            # in WAL mode readers don't wait for the writer and the writer doesn't wait for readers.
+            # The mode is stored in the file, so only the first connection has to switch it.
+            if conn.execute('pragma journal_mode').fetchone()[0] != 'wal':
+                conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            conn.execute(f'pragma wal_autocheckpoint={int(self.wal_autocheckpoint)}')
+        conn.row_factory = row_factory
+        return conn
+
+
+    def _get_conn(self) -> sqlite3.Connection:
+        return self.conn
+
+
+    def checkpoint(self, mode: str='PASSIVE') -> tuple:
+        """Copy the WAL back into the database. PASSIVE never waits on readers; TRUNCATE also
+        empties the WAL file but waits (up to busy_timeout) for readers to finish.
+        Returns (busy, wal pages, checkpointed pages); the page counts are -1 when not in WAL mode."""
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(mode)
+        return tuple(self.run_query_tuple(f'pragma wal_checkpoint({mode})')[0])
+
 
     def save(self):
-        self.conn.commit()
+        self._get_conn().commit()
+
+
+    def rollback(self):
+        self._get_conn().rollback()
 
 
     def close(self):
@@ -40,31 +88,97 @@ class SqliteDb:
 
 
     def _set_row_factory(self, dict_row: bool):
-        if dict_row and not self.conn.row_factory:
-            self.conn.row_factory = row_factory
+        conn = self._get_conn()
+        if dict_row and not conn.row_factory:
+            conn.row_factory = row_factory
             return
 
-        if not dict_row and self.conn.row_factory:
-            self.conn.row_factory = None
+        if not dict_row and conn.row_factory:
+            conn.row_factory = None
             return
 
 
+    def _query_endpoint(self) -> str:
+        """What the query is being run for, if known; FlaskImageDb returns the web endpoint."""
+        return None
+
+
+    def _explain(self, sql_string: str, params: tuple=None) -> list[str]:
+        cursor = self._get_conn().cursor()
+        cursor.row_factory = None
+        try:
+            return [row[3] for row in cursor.execute('explain query plan ' + sql_string, params or ())]
+        except sqlite3.Error as e:
+            return [f'no plan: {e}']
+        finally:
+            cursor.close()
+
+
+    def _record_query(self, seconds: float, sql_string: str, params, many: bool=False):
+        method = calling_method(('sqlitedb.py', 'query_stats.py'))
+        endpoint = self._query_endpoint()
+        self.query_stats.record(method, seconds, endpoint)
+
+        if self.query_stats.is_slow(seconds):
+            if many:
+                plan, params = [], '<executemany>'
+            else:
+                plan = self._explain(sql_string, params)
+            self.query_stats.record_slow(method, seconds, sql_string, params, plan, endpoint)
+
+
     def _run_query(self, sql_string: str, params: tuple=None, commit: bool=False, dict_row: bool=True):
         if self.sql_echo:
             print(f'{sql_string=}\n{params=}')
 
         self._set_row_factory(dict_row)
 
-        cursor = self.conn.execute(sql_string, params or ())
+        start = perf_counter()
+        cursor = self._get_conn().execute(sql_string, params or ())
         results = cursor.fetchall()
         cursor.close()
+        if self.query_stats is not None:
+            self._record_query(perf_counter() - start, sql_string, params)
 
         if commit:
-            self.conn.commit()
+            self.save()
 
         return results
 
 
+    def iter_query(self, sql_string: str, params: tuple=None, dict_row: bool=True, arraysize: int=1000):
+        """Yield the rows of a query, fetching `arraysize` rows at a time rather than all at once.
+
+        dict_row=False yields plain tuples. The row factory is set on this query's own cursor,
+        so other queries on the connection can run while the generator is being consumed.
+        Don't write to the tables being read until it is exhausted.
+
+        The time spent in sqlite, not in the consumer between fetches, is recorded once the
+        query is exhausted or the generator is closed.
+        """
+        if self.sql_echo:
+            print(f'{sql_string=}\n{params=}')
+
+        cursor = self._get_conn().cursor()
+        cursor.row_factory = row_factory if dict_row else None
+        cursor.arraysize = arraysize
+        seconds = 0.0
+        try:
+            start = perf_counter()
+            cursor.execute(sql_string, params or ())
+            rows = cursor.fetchmany()
+            seconds += perf_counter() - start
+            while rows:
+                yield from rows
+                start = perf_counter()
+                rows = cursor.fetchmany()
+                seconds += perf_counter() - start
+        finally:
+            cursor.close()
+            if self.query_stats is not None:
+                self._record_query(seconds, sql_string, params)
+
+
     def run_query_tuple(self, sql_string: str, params: tuple=None, commit: bool=False):
         return self._run_query(sql_string, params, commit=commit, dict_row=False)
 
@@ -79,12 +193,33 @@ class SqliteDb:
 
         self._set_row_factory(dict_row)
 
-        cursor = self.conn.executemany(sql_string, params or ())
+        start = perf_counter()
+        cursor = self._get_conn().executemany(sql_string, params or ())
         results = cursor.fetchall()
         cursor.close()
+        if self.query_stats is not None:
+            self._record_query(perf_counter() - start, sql_string, params, many=True)
 
         if commit:
-            self.conn.commit()
+            self.save()
 
         return results
 
+
+    def run_write_many(self, sql_string: str, params: list=None, commit: bool=False) -> int:
+        """executemany for writes. Returns the number of rows changed, not counting changes made by triggers."""
+        if self.sql_echo:
+            print(f'{sql_string=}\n{params=}')
+
+        start = perf_counter()
+        cursor = self._get_conn().executemany(sql_string, params or ())
+        rowcount = cursor.rowcount
+        cursor.close()
+        if self.query_stats is not None:
+            self._record_query(perf_counter() - start, sql_string, params, many=True)
+
+        if commit:
+            self.save()
+
+        return rowcount
+
@@ -117,6 +117,45 @@ function toggleTheme() {
 const savedTheme = localStorage.getItem('theme') || 'light';
 setTheme(savedTheme);
 
+function escapeHtml(value) {
+    // query text and params carry user input, so anything from the stats goes through here before innerHTML
+    return String(value ?? '').replace(/[&<>"']/g, (c) => ({ '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c]));
+}
+
+function timingsTable(title, rows) {
+    // rows: [{name, count, avg_ms, p50_ms, p95_ms, p99_ms, max_ms}], already sorted by p99
+    let html = `<h4>${title}</h4><table class="stats-table"><thead><tr><th>Name</th><th>Count</th><th>Avg ms</th><th>p50</th><th>p95</th><th>p99</th><th>Max</th></tr></thead><tbody>`;
+    for (const t of rows) {
+        html += `<tr><td>${escapeHtml(t.name)}</td><td>${t.count}</td><td>${t.avg_ms}</td><td>${t.p50_ms}</td><td>${t.p95_ms}</td><td>${t.p99_ms}</td><td>${t.max_ms}</td></tr>`;
+    }
+    return html + '</tbody></table>';
+}
+
+async function performQueryStats() {
+    clearAll();
+    results_div.innerHTML = '<p>Loading...</p>';
+    try {
+        const resp = await fetch('/api/stats');
+        if (!resp.ok) throw new Error(`stats failed: ${resp.status}`);
+        const data = await resp.json();
+        const queries = data.queries;
+        if (!queries) {
+            results_div.innerHTML = '<h3>Query stats are turned off (query_stats in the configs).</h3>';
+            return;
+        }
+        let html = timingsTable('Queries by endpoint', queries.endpoints);
+        html += timingsTable('Queries by method', queries.methods);
+        html += `<h4>Slow queries (over ${queries.slow_ms} ms), newest first</h4>`;
+        html += queries.slow.map((q) =>
+            `<div class="stats-slow"><b>${q.ms} ms</b> ${escapeHtml(q.at)} ${escapeHtml(q.method)} ${escapeHtml(q.endpoint)}<pre>${escapeHtml(`${q.sql}\n${q.params}\n${q.plan.join('\n')}`)}</pre></div>`
+        ).join('') || '<p>None</p>';
+        results_div.innerHTML = html;
+    } catch (err) {
+        console.error(err);
+        results_div.innerHTML = '<p>Error loading stats.</p>';
+    }
+}
+
 // Admin page navigation
 document.getElementById('admin_back_btn').addEventListener('click', () => { window.location.href = '/'; });
 
@@ -125,5 +164,6 @@ document.getElementById('dupl_button').addEventListener('click', () => performRe
 document.getElementById('dupl_button2').addEventListener('click', () => performReconcileDupesAuto());
 document.getElementById('remove_del_btn').addEventListener('click', () => performRemoveDeleted());
 document.getElementById('tagEdit_btn').addEventListener('click', () => performEditTag());
+document.getElementById('query_stats_btn').addEventListener('click', () => performQueryStats());
 
 fetchAllTags();
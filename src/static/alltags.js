@@ -58,7 +58,7 @@ async function renderAllTagsView() {
         } else {
             html += `<div class="alltags-grid">`;
             html += data.results.map(tag => {
-                const imgSrc = tag.image_path ? `/serve?p=${encodeURIComponent(tag.image_path)}` : '';
+                const imgSrc = tag.image_id ? `/thumb?id=${tag.image_id}` : '';
                 return `
                     <div class="alltags-card" data-id="${tag.tag_id}" data-name="${tag.tag_name}">
                         <div class="alltags-thumb">
@@ -154,12 +154,9 @@ function reconcileOneDupe() {
     });
 }
 
-async function finalizeDupesAuto(eventSource) {
+async function finalizeDupesAuto() {
     // When the 'auto delete' part is done, the database contains the
     // remaining dupes, fetched the same as 'reconcile dupes' does.
-    progressBar.style.width = "100%";
-    progressBar.textContent = "Done!";
-    eventSource.close();
 
     // TODO error handling    
     let resp = await fetch(`/dupl_images`);
@@ -185,17 +182,10 @@ async function performReconcileDupesAuto() {
     progressBar.textContent = "0%";
 
     // TODO error handling
-    await fetch(`/dupl_images_auto_del`);    
+    const resp = await fetch(`/dupl_images_auto_del`, { method: "POST" });
+    const started = await resp.json();
 
-    const eventSource = new EventSource("/progress");
-
-    eventSource.onmessage = (event) => {
-        const progress = event.data;
-        progressBar.style.width = progress + "%";
-        progressBar.textContent = progress + "%";
-    };
-
-    eventSource.addEventListener("done", () => finalizeDupesAuto(eventSource));
+    watchJob(started.job_id, () => finalizeDupesAuto());
 }
 
 async function performReconcileDupes() {
@@ -222,24 +212,55 @@ async function performReconcileDupes() {
 }
 
 const progressBar = document.getElementById("progress-bar");
-async function performRemoveDeleted() {
-    progressBar.style.width = "0%";
-    progressBar.textContent = "0%";
+const cancelJobBtn = document.getElementById("job_cancel_btn");
+let currentJobId = null;
 
-    await fetch("/remove_deleted", { method: "POST" });
-    
-    const eventSource = new EventSource("/progress");
+function watchJob(jobId, onDone) {
+    // Follow a background job on the progress bar until it finishes, then call onDone(job)
+    currentJobId = jobId;
+    cancelJobBtn.style.display = "";
+    const eventSource = new EventSource(`/jobs/${jobId}/events`);
 
     eventSource.onmessage = (event) => {
-        const progress = event.data;
-        progressBar.style.width = progress + "%";
-        progressBar.textContent = progress + "%";
+        const job = JSON.parse(event.data);
+        progressBar.style.width = job.percent + "%";
+        progressBar.textContent = job.eta_s === null ? `${job.percent}%` : `${job.percent}% (${Math.ceil(job.eta_s)}s left)`;
     };
 
-    eventSource.addEventListener("done", () => {
-        progressBar.style.width = "100%";
-        progressBar.textContent = "Done!";
+    eventSource.addEventListener("done", (event) => {
         eventSource.close();
+        currentJobId = null;
+        cancelJobBtn.style.display = "none";
+        cancelJobBtn.textContent = "Cancel";
+
+        const job = JSON.parse(event.data);
+        progressBar.style.width = "100%";
+        if (job.state === "done") {
+            progressBar.textContent = "Done!";
+        } else if (job.state === "failed") {
+            progressBar.textContent = `Failed: ${job.error}`;
+        } else {
+            progressBar.textContent = "Cancelled";
+        }
+        onDone(job);
     });
 }
 
+cancelJobBtn.addEventListener("click", async () => {
+    if (currentJobId === null) return;
+    cancelJobBtn.textContent = "Cancelling...";
+    try {
+        await fetch(`/jobs/${currentJobId}/cancel`, { method: "POST" });
+    } catch (err) { console.error(err); }
+});
+
+async function performRemoveDeleted() {
+    progressBar.style.width = "0%";
+    progressBar.textContent = "0%";
+
+    const resp = await fetch("/remove_deleted", { method: "POST" });
+    const started = await resp.json();
+
+    watchJob(started.job_id, () => {});
+}
+
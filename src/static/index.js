@@ -116,12 +116,17 @@ async function applyTagChanges() {
     /* User clicks on apply button. Send the current tag set to the server to update the database. */
 
     hideWarn();
-    const params = new URLSearchParams();
-    infoPaneImages.forEach(id => params.append('image_ids', id));
-    active_info_tags.forEach(blah => params.append('tag_ids', blah.tag_id));
-    active_text_tags.forEach(blah => params.append('text_tags', blah));
+    const body = {
+        image_ids: infoPaneImages,
+        tag_ids: active_info_tags.map(blah => blah.tag_id),
+        text_tags: active_text_tags,
+    };
     try {
-        const resp = await fetch(`/api/applyTagChanges?${params.toString()}`);
+        const resp = await fetch('/api/applyTagChanges', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body),
+        });
         if (!resp.ok) { throw new Error(`Apply tag changes failed: ${resp.status}`); }
     } catch (err) { console.error(err); }
     void updateMRAtags();
@@ -242,16 +247,33 @@ async function updateMRAtags() {
     });
 }
 
-function handleAddTagInput(inputEl, suggestionDiv) {
+async function fetchTagSuggestions(query, typeId=null) {
+    // ranked matches from the server's tag name index
+    const params = new URLSearchParams();
+    params.append('q', query);
+    params.append('limit', 50);
+    if (typeId !== null) params.append('tag_type_id', typeId);
+    try {
+        const resp = await fetch(`/tags/autocomplete?${params.toString()}`);
+        if (!resp.ok) { throw new Error(`autocomplete failed: ${resp.status}`); }
+        const data = await resp.json();
+        return data.results;
+    } catch (err) {
+        console.error(err);
+        return [];
+    }
+}
+
+async function handleAddTagInput(inputEl, suggestionDiv) {
     
     const query = inputEl.value.trim().toLowerCase();
     suggestionDiv.innerHTML = '';
     if (!query) { return; }
 
-    const filtered = Array.from(all_tags.values())
-        .filter((tag) => tag[1].toLowerCase().includes(query));
+    const filtered = await fetchTagSuggestions(query);
+    if (inputEl.value.trim().toLowerCase() !== query) return; // a newer keystroke owns the list
     suggestionDiv.innerHTML = filtered.map((tag) =>
-        `<div class="tag_suggestion" data-id="${tag[0]}" data-tag_type_id="${tag[2]}">${tag[1]}</div>`
+        `<div class="tag_suggestion" data-id="${tag.tag_id}" data-tag_type_id="${tag.tag_type_id}">${tag.tag_name.toLowerCase()}</div>`
     ).join('');
 
     document.getElementById('addtag_suggestions').querySelectorAll('.tag_suggestion').forEach((el) => {
@@ -332,24 +354,15 @@ function parseTagField(fieldId) {
     }).filter(Boolean);
 }
 
-function handleTagInput(inputEl, suggestionDiv, typeId, ignoreTypeId=false) {
+async function handleTagInput(inputEl, suggestionDiv, typeId, ignoreTypeId=false) {
     const query = inputEl.value.trim().toLowerCase();
     suggestionDiv.innerHTML = '';
     if (!query) {return;}
-    if (ignoreTypeId) {
-        const filtered = Array.from(all_tags.values())
-            .filter((tag) => tag[1].toLowerCase().includes(query));
-        suggestionDiv.innerHTML = filtered.map((tag) =>
-            `<div class="tag_suggestion" data-id="${tag[0]}" data-type_id="${tag[2]}">${tag[1]}</div>`
-        ).join('');
-    }
-    else {
-        const filtered2 = Array.from(all_tags.values())
-            .filter((tag) => tag[2] === typeId && tag[1].toLowerCase().includes(query));
-        suggestionDiv.innerHTML = filtered2.map((tag) =>
-            `<div class="tag_suggestion" data-id="${tag[0]}" data-type_id="${tag[2]}">${tag[1]}</div>`
-        ).join('');
-    }
+    const filtered = await fetchTagSuggestions(query, ignoreTypeId ? null : typeId);
+    if (inputEl.value.trim().toLowerCase() !== query) return; // a newer keystroke owns the list
+    suggestionDiv.innerHTML = filtered.map((tag) =>
+        `<div class="tag_suggestion" data-id="${tag.tag_id}" data-type_id="${tag.tag_type_id}">${tag.tag_name.toLowerCase()}</div>`
+    ).join('');
     attachSuggestionEvents(suggestionDiv, (typeId === CharacterTagTypeId ? selected_character_tags : selected_general_tags),
         (typeId === CharacterTagTypeId ? renderCharacterTags : renderGeneralTags), (typeId === CharacterTagTypeId ? 'file_tags_character' : 'file_tags_general'));
 }
@@ -517,7 +530,7 @@ function renderResults(data) {
             html += data.results.map((result) => `
                 <div class="m row">
                     <div class="img-card">
-                    <img data-id="${result.image_id}" alt="" src="/serve?p=${encodeURIComponent(result.image_path)}" loading="lazy"/></div>
+                    <img data-id="${result.image_id}" alt="" data-thumb="${result.image_id}" data-full="/serve?p=${encodeURIComponent(result.image_path)}" loading="lazy"/></div>
                     <div class="outer_pills">
                         <p class="fn">${result.image_path}</p>
                         <div class="pills">
@@ -533,17 +546,78 @@ function renderResults(data) {
             `).join('');
         } else {
             const r = data.results.map(result => `<div class="img-card"><div class="imgchk"><input type="image" src="/static/eye.svg" data-id="${result.image_id}" alt=""></div>
-                <img data-id="${result.image_id}" alt="" src="/serve?p=${encodeURIComponent(result.image_path)}"
+                <img data-id="${result.image_id}" alt="" data-thumb="${result.image_id}" data-full="/serve?p=${encodeURIComponent(result.image_path)}"
                 loading="lazy" title="${result.image_path}&#013;&#013;${render_all_top_tags(result)}"/></div>`).join('');
             html += `<div class="grid">${r}</div>`;
         }
     }
     results_div.innerHTML = html;
+    void loadThumbnails(results_div);
     
     updateSelect(); /* on mode change, need to update selected image markers */
     updatePagination(data);
 }
 
+let thumbUrls = [];         // object URLs of the thumbnails on the current page
+let thumbsAbort = null;
+
+async function loadThumbnails(container) {
+    /* fetch every thumbnail on the page in one /thumbs request, showing each as it arrives */
+    if (thumbsAbort) thumbsAbort.abort();
+    thumbUrls.forEach((url) => URL.revokeObjectURL(url));
+    thumbUrls = [];
+
+    const waiting = new Map(); // image id -> img elements still without a src
+    container.querySelectorAll('img[data-thumb]').forEach((img) => {
+        if (!waiting.has(img.dataset.thumb)) waiting.set(img.dataset.thumb, []);
+        waiting.get(img.dataset.thumb).push(img);
+    });
+    if (waiting.size === 0) return;
+
+    const abort = new AbortController();
+    thumbsAbort = abort;
+    try {
+        const resp = await fetch(`/thumbs?ids=${[...waiting.keys()].join(',')}`, { signal: abort.signal });
+        if (!resp.ok) throw new Error(`thumbs failed: ${resp.status}`);
+        const type = resp.headers.get('X-Thumbnail-Type');
+        const reader = resp.body.getReader();
+
+        // records: image id and byte length (big-endian uint32s), then the bytes
+        let buf = new Uint8Array(0);
+        for (;;) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            const joined = new Uint8Array(buf.length + value.length);
+            joined.set(buf);
+            joined.set(value, buf.length);
+            buf = joined;
+
+            while (buf.length >= 8) {
+                const view = new DataView(buf.buffer, buf.byteOffset, 8);
+                const id = String(view.getUint32(0));
+                const len = view.getUint32(4);
+                if (buf.length < 8 + len) break;
+
+                const imgs = waiting.get(id) || [];
+                waiting.delete(id);
+                if (len > 0) {
+                    const url = URL.createObjectURL(new Blob([buf.subarray(8, 8 + len)], { type: type }));
+                    thumbUrls.push(url);
+                    imgs.forEach((img) => { img.src = url; });
+                } else {
+                    imgs.forEach((img) => { img.src = `/thumb?id=${id}`; });
+                }
+                buf = buf.slice(8 + len);
+            }
+        }
+    } catch (err) {
+        if (err.name === 'AbortError') return; // a newer page replaced this one
+        console.error(err);
+    }
+    // anything the batch didn't deliver is loaded on its own
+    waiting.forEach((imgs, id) => imgs.forEach((img) => { img.src = `/thumb?id=${id}`; }));
+}
+
 function updatePagination(data) {
 
     per_page = (Number.isNaN(per_page) ? DefaultPerPage : per_page);
@@ -584,6 +658,10 @@ function updatePagination(data) {
     document.getElementById('next_page2').addEventListener('click', () => nextPage());
 }
 
+let search_cursor = null;   // resumes the current search at page search_cursor_page
+let search_cursor_page = 0;
+let search_tot_found = 0;
+
 async function performTagSearchGuts(isPagination) {
     /* Common functionality for "Search by Tags" and tag-links in the Explore grid
      */
@@ -595,15 +673,23 @@ async function performTagSearchGuts(isPagination) {
     if (!generalIds.length && !characterIds.length) { return; }
 
     const params = makeSearchURLParams(generalIds, characterIds);
+    // A new search, or stepping forward one page, uses the server's cursor; other page jumps use the page number
+    if (!isPagination) { params.append('cursor', ''); }
+    else if (search_cursor && current_page === search_cursor_page) { params.append('cursor', search_cursor); }
     try {
         const resp = await fetch(`/search_w_tags?${params.toString()}`);
         if (!resp.ok) { throw new Error(`Tag search failed: ${resp.status}`); }
-        renderResults(await resp.json());
+        const data = await resp.json();
+        if (data.tot_found === null) { data.tot_found = search_tot_found; } // only counted on the first page
+        search_tot_found = data.tot_found;
+        search_cursor = data.cursor || null;
+        search_cursor_page = current_page + 1;
+        renderResults(data);
     } catch (err) { console.error(err); }
     
 }
 
-let randstate = "";
+let randseed = ""; // fixes the random order while paging
 //let inRandom = false;
 
 function makeSearchURLParams(generalIds, characterIds) {
@@ -624,20 +710,20 @@ async function performRandom(isPagination=false) {
     window.inRandom = true;
     if (!isPagination) {
         current_page = 1;
-        randstate = "";
+        randseed = "";
     }
     
     const generalIds = selected_general_tags.map((t) => t.tag_id);
     const characterIds = selected_character_tags.map((t) => t.tag_id);
 
     const params = makeSearchURLParams(generalIds, characterIds);
-    params.append('state', randstate);
+    params.append('seed', randseed);
     
     try {
         const resp = await fetch(`/random_search_w_tags?${params.toString()}`);
         if (!resp.ok) { throw new Error(`Random search failed: ${resp.status}`); }
         let results = await resp.json();
-        randstate = results.randstate;
+        randseed = results.seed;
         renderResults(results);
     } catch (err) { console.error(err); }
     
@@ -27,7 +27,8 @@ function openLightbox(img) {
     const firsttime = (currImg === null);
 
     currImg = img;
-    lightboxImg.src = img.src;
+    // gallery images are thumbnails, the lightbox shows the original
+    lightboxImg.src = img.dataset.full || img.src;
     zoom = 1; panX = panY = 0;
     updateTransform();
     lightbox.classList.add('active');
@@ -5,7 +5,9 @@ from time import perf_counter
 from configs import TaggerConfigs, configs
 from db import ImageDb
 from enums import Ext
+from metadata import ExifToolPool, ingest_image_meta
 from tag_data import get_tag_data
+from thumbnails import ThumbnailCache
 from utils import get_sha256_from_path, get_torch_device, printr
 
 
@@ -13,7 +15,9 @@ class Tagger:
     def __init__(self, configs: TaggerConfigs):
         self.configs: TaggerConfigs = configs
 
-        self.db: ImageDb = ImageDb(self.configs.db_path, self.configs.sql_echo)
+        self.db: ImageDb = ImageDb(self.configs.db_path, self.configs.sql_echo, wal=self.configs.sqlite_wal,
+            busy_timeout=self.configs.sqlite_busy_timeout, wal_autocheckpoint=self.configs.sqlite_wal_autocheckpoint)
+        self.db.root_path = self.configs.root_path
 
         printr('init tagging, started\n')
         self.db.init_tagging()
@@ -81,8 +85,13 @@ class Tagger:
         from processor import process_images_from_paths
         self.load_model()
 
-        untagged_image_tuples = self.db.get_untagged_images()
-        print(f'Found {len(untagged_image_tuples)} non-tagged images in database for all directories')
+        thumbnails = None
+        if self.configs.tagger_thumbnails:
+            thumbnails = ThumbnailCache(self.configs.thumbnail_dir, size=self.configs.thumbnail_size, fmt=self.configs.thumbnail_format,
+                quality=self.configs.thumbnail_quality, max_bytes=self.configs.thumbnail_cache_mb * 1024**2, workers=1)
+
+        print(f'Found {self.db.count_untagged_images()} non-tagged images in database for all directories')
+        untagged_image_tuples = self.db.iter_untagged_images(self.configs.sql_insert_batch_size)
 
         timesum = 0
         count = 0
@@ -121,6 +130,7 @@ class Tagger:
                     self.configs.min_general_tag_val,
                     self.configs.min_character_tag_val,
                     by_idx=True,
+                    on_image=thumbnails.save_from_image if thumbnails else None,
                 )
                 count_completed += 1
             except Exception as e:
@@ -158,9 +168,20 @@ class Tagger:
         print(f'Total time: {timesum:.3f}s')
         print(f'Time per image: {timesum/max(count, 1):.3f}s')
 
+        if self.configs.tagger_meta:
+            pool = ExifToolPool(self.configs.exiftool_processes)
+            try:
+                ingest_image_meta(self.db, pool, self.configs.meta_fields)
+            finally:
+                pool.close()
+
         if self.configs.commit_tags:
-            self.db.update_tag_counts()
-            self.db.save_and_close()
+            self.db.refresh_tag_rep_images()
+            self.db.save()
+            if self.configs.sqlite_wal:
+                # shrink the WAL now that the run is over; waits at most busy_timeout on web readers
+                self.db.checkpoint('TRUNCATE')
+            self.db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from time import monotonic, time
+from typing import BinaryIO
+
+from PIL import Image, ImageOps
+
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+
+class ThumbnailCache:
+    """Resized copies of images, stored under `cache_dir` and generated on demand.
+
+    A thumbnail's file name is a hash of the source path, the source's mtime and size, and the
+    thumbnail size, so an edited or replaced image gets a fresh thumbnail and the stale one ages
+    out. Misses are rendered on a pool of `workers` threads; concurrent requests for the same
+    thumbnail wait on the one render. The least recently used files are deleted once the cache
+    holds more than `max_bytes`.
+
+    Other processes (the tagger, other gunicorn workers) may share the cache dir. File mtimes
+    order the cache for all of them, and every `sync_seconds` the index is rebuilt from the
+    directory, so the size limit applies to the directory as a whole.
+    """
+    def __init__(self, cache_dir: str, size: int=256, fmt: str='webp', quality: int=80, max_bytes: int=2 * 1024**3, workers: int=4, sync_seconds: float=60.0):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unsupported thumbnail format {fmt!r}, expected one of {list(FORMATS)}')
+
+        self.cache_dir = cache_dir
+        self.size = size
+        self.fmt = fmt
+        self.pil_format, self.mimetype = FORMATS[fmt]
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.sync_seconds = sync_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+        self.bytes = 0
+
+        self._files: OrderedDict[str, int] = OrderedDict() # thumbnail path -> size, least recently used first
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self._synced_at = monotonic()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._sync()
+
+
+    def _sync(self):
+        """Rebuild the index from the cache dir, with what other processes have written and evicted."""
+        found = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                    if entry.name.endswith('.tmp'):
+                        if st.st_mtime < time() - 3600:
+                            os.remove(entry.path) # left over from an interrupted render
+                    elif entry.is_file():
+                        found.append((st.st_mtime, entry.path, st.st_size))
+                except FileNotFoundError:
+                    pass # evicted meanwhile
+
+        # hits touch the file, so mtime orders the cache from least to most recently used
+        with self._lock:
+            self._files = OrderedDict((path, size) for _, path, size in sorted(found))
+            self.bytes = sum(self._files.values())
+            self._synced_at = monotonic()
+            self._evict()
+
+
+    def thumb_path(self, src_path: str, st: os.stat_result) -> str:
+        key = hashlib.sha1(f'{src_path}\0{st.st_mtime_ns}\0{st.st_size}\0{self.size}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{self.fmt}')
+
+
+    def _lookup(self, src_path: str) -> str | Future | None:
+        """The thumbnail path on a hit, else the Future of its render. None if the source can't be read."""
+        try:
+            st = os.stat(src_path)
+        except OSError:
+            return None
+        thumb_path = self.thumb_path(src_path, st)
+
+        with self._lock:
+            cached = thumb_path in self._files
+        if not cached:
+            try:
+                size = os.path.getsize(thumb_path) # rendered by another process sharing the cache dir
+            except OSError:
+                size = None
+
+        with self._lock:
+            if cached or size is not None:
+                if not cached:
+                    self._add(thumb_path, size)
+                self._files.move_to_end(thumb_path)
+                self.hits += 1
+            else:
+                future = self._pending.get(thumb_path)
+                if future is None:
+                    self.misses += 1
+                    future = self._pool.submit(self._render_file, src_path, thumb_path)
+                    self._pending[thumb_path] = future
+                else:
+                    self.coalesced += 1
+                return future
+
+        try:
+            os.utime(thumb_path)
+            return thumb_path
+        except FileNotFoundError:
+            # deleted by another process sharing the cache dir
+            self._forget(thumb_path)
+            return self._lookup(src_path)
+
+
+    def get(self, src_path: str) -> str | None:
+        """Path of the thumbnail for `src_path`, rendering it first if needed. None if the source can't be read."""
+        result = self._lookup(src_path)
+        return result.result() if isinstance(result, Future) else result
+
+
+    def open(self, src_path: str) -> BinaryIO | None:
+        """The thumbnail for `src_path` opened for reading, rendered again if it is evicted before
+        it can be opened. None if the source can't be read. An open file outlives its eviction."""
+        for _ in range(3):
+            thumb_path = self.get(src_path)
+            if thumb_path is None:
+                return None
+            try:
+                return open(thumb_path, 'rb')
+            except FileNotFoundError:
+                self._forget(thumb_path) # evicted since the lookup, by this or another process
+        return None
+
+
+    def get_many(self, src_paths: list[str]):
+        """Yield (src_path, thumbnail path or None) for each path: cached thumbnails first,
+        then the rest as their renders finish, all of them rendering at once on the pool."""
+        pending: dict[Future, list[str]] = {}
+        for src_path in src_paths:
+            result = self._lookup(src_path)
+            if isinstance(result, Future):
+                pending.setdefault(result, []).append(src_path)
+            else:
+                yield src_path, result
+
+        for future in as_completed(pending):
+            for src_path in pending[future]:
+                yield src_path, future.result()
+
+
+    def save_from_image(self, src_path: str, img: Image.Image):
+        """Write the thumbnail for `src_path` from an image that is already open, e.g. by the tagger."""
+        try:
+            thumb_path = self.thumb_path(src_path, os.stat(src_path))
+            if thumb_path in self._files or os.path.isfile(thumb_path):
+                return
+            self._write(self._shrink(img), thumb_path)
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self.errors += 1
+            print(f'Thumbnail failed for {src_path}: {e}')
+
+
+    def _render_file(self, src_path: str, thumb_path: str) -> str | None:
+        try:
+            with Image.open(src_path) as img:
+                img.draft('RGB', (self.size, self.size)) # JPEGs decode straight to a fraction of their size
+                self._write(self._shrink(img), thumb_path)
+            return thumb_path
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            with self._lock:
+                self.errors += 1
+            print(f'Thumbnail failed for {src_path}: {e}')
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(thumb_path, None)
+
+
+    def _shrink(self, img: Image.Image) -> Image.Image:
+        scale = min(1.0, self.size / max(img.size))
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        thumb = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        thumb = ImageOps.exif_transpose(thumb)
+
+        if thumb.mode not in ['RGB', 'RGBA']:
+            thumb = thumb.convert('RGBA') if 'transparency' in thumb.info else thumb.convert('RGB')
+        if thumb.mode == 'RGBA' and self.pil_format == 'JPEG':
+            background = Image.new('RGBA', thumb.size, (255, 255, 255))
+            background.alpha_composite(thumb)
+            thumb = background.convert('RGB')
+        return thumb
+
+
+    def _write(self, thumb: Image.Image, thumb_path: str):
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        tmp_path = f'{thumb_path}.{threading.get_ident()}.tmp'
+        thumb.save(tmp_path, self.pil_format, quality=self.quality)
+        os.replace(tmp_path, thumb_path) # readers never see a partial file
+
+        size = os.path.getsize(thumb_path)
+        with self._lock:
+            self._add(thumb_path, size)
+            sync = monotonic() - self._synced_at >= self.sync_seconds
+            if sync:
+                self._synced_at = monotonic() # one thread syncs, the rest carry on
+        if sync:
+            self._sync()
+
+
+    def _add(self, thumb_path: str, size: int):
+        # called with the lock held
+        if thumb_path in self._files:
+            self.bytes -= self._files[thumb_path]
+        self._files[thumb_path] = size
+        self.bytes += size
+        self._evict()
+
+
+    def _forget(self, thumb_path: str):
+        with self._lock:
+            size = self._files.pop(thumb_path, None)
+            if size is not None:
+                self.bytes -= size
+
+
+    def _evict(self):
+        # called with the lock held
+        while self._files and self.bytes > self.max_bytes:
+            thumb_path, size = self._files.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(thumb_path)
+            except FileNotFoundError:
+                pass
+
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'files': len(self._files),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'size': self.size,
+                'format': self.fmt,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'errors': self.errors,
+                'evictions': self.evictions,
+                'pending': len(self._pending),
+            }
@@ -0,0 +1,43 @@
+
+import os,sys
+import random
+from time import perf_counter
+from configs import TaggerConfigs, configs
+from db import ImageDb
+
+
+if __name__ == '__main__':
+
+  # Verify and fetch command line arguments
+  sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+  runs = 5
+
+  # Open database
+  me_configs: TaggerConfigs = configs
+  if not os.path.exists(me_configs.db_path):
+      print(f"Can't open database: '{me_configs.db_path}'")
+      exit()
+
+  me_db: ImageDb = ImageDb(me_configs.db_path, me_configs.sql_echo)
+
+  image_ids = [row[0] for row in me_db.run_query_tuple("select image_id from image where general is not null")]
+  print(f"{len(image_ids):,} tagged images")
+
+  for size in sizes:
+    if size > len(image_ids):
+      print(f"{size:>6} images: skipped, not enough images")
+      continue
+
+    for partial in (False, True):
+      timings = []
+      for _ in range(runs):
+        selection = random.sample(image_ids, size)
+        start = perf_counter()
+        results = me_db.get_common_tags(selection, 0, 0.0, include_partial=partial)
+        timings.append(perf_counter() - start)
+      timings.sort()
+      label = "partial" if partial else "common"
+      print(f"{size:>6} images, {label:>7}: median {timings[runs // 2] * 1000:.2f}ms  max {timings[-1] * 1000:.2f}ms  ({len(results)} tags)")
+
+  me_db.close()
+  exit()
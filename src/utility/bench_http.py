@@ -0,0 +1,395 @@
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from urllib.parse import urlencode
+
+from PIL import Image
+
+from db import ImageDb
+from enums import Ratings
+from query_stats import percentile
+from tag_data import get_tag_data
+from utils import make_path, printr
+
+
+# relative weights of each kind of request, roughly what one person browsing the gallery sends
+DEFAULT_MIX = {
+    'search_w_tags': 30,
+    'random_search_w_tags': 10,
+    'top_tags': 10,
+    'cloud_tags': 5,
+    'tags_by_letter': 10,
+    'serve': 30,
+    'applyTagChanges': 5,
+}
+
+
+class Library:
+    """A generated database, and image files for the first `n_files` of its images.
+
+    Tag popularity follows a Zipf distribution over the tags in tags.csv, so a few tags are on
+    most images and most tags are rare, as in a real library.
+    """
+    def __init__(self, work_dir: str, n_images: int, tags_per_image: int, n_files: int, seed: int):
+        self.media_root = os.path.join(work_dir, 'media')
+        self.db_path = os.path.join(work_dir, f'library-{n_images}-{tags_per_image}-{seed}.db')
+        self.n_images = n_images
+        self.tags_per_image = tags_per_image
+        self.n_files = min(n_files, n_images)
+        self.seed = seed
+
+        tag_data = get_tag_data()
+        self.general_tag_ids = tag_data.general
+        self.character_tag_ids = tag_data.character
+        self.letters = sorted({name[0] for name in tag_data.names if name[:1].isascii() and name[:1].isalpha()})
+
+
+    def path(self, i: int) -> tuple[str, str]:
+        return os.path.join(self.media_root, f'set{i // 10_000:03}', f'part{i // 1_000 % 10}'), f'img{i:08}.png'
+
+
+    def build(self):
+        if os.path.exists(self.db_path):
+            print(f'Reusing {self.db_path}')
+        else:
+            self._build_db()
+        self._write_files()
+
+
+    def _build_db(self):
+        rnd = random.Random(self.seed)
+        general_weights = [1 / (rank + 1) for rank in range(len(self.general_tag_ids))]
+        character_weights = [1 / (rank + 1) for rank in range(len(self.character_tag_ids))]
+
+        tmp_path = f'{self.db_path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db = ImageDb(tmp_path)
+        db.init_tagging()
+
+        start = perf_counter()
+        for i in range(self.n_images):
+            tag_ids = set()
+            while len(tag_ids) < self.tags_per_image:
+                tag_ids.update(rnd.choices(self.general_tag_ids, general_weights, k=self.tags_per_image - len(tag_ids)))
+            tag_id_2_prob = {tag_id: round(rnd.uniform(0.35, 1.0), 3) for tag_id in tag_ids}
+            if rnd.random() < 0.3:
+                tag_id_2_prob[rnd.choices(self.character_tag_ids, character_weights)[0]] = round(rnd.uniform(0.5, 1.0), 3)
+
+            # mostly general, with a sensitive/questionable/explicit tail
+            rating = rnd.choices(list(Ratings), [70, 15, 10, 5])[0]
+            ratings = {r.value: round(rnd.uniform(0.6, 1.0) if r == rating else rnd.uniform(0.0, 0.3), 3) for r in Ratings}
+
+            directory, filename = self.path(i)
+            db.insert_image_tags(db.get_directory_id(directory), filename, ratings, tag_id_2_prob, sha256=f'{rnd.getrandbits(256):064x}')
+            if i % 10_000 == 9_999:
+                db.save()
+                printr(f'Library: {i + 1:,}/{self.n_images:,} images  {perf_counter() - start:.1f}s')
+
+        db.refresh_tag_rep_images()
+        db.save()
+        db.close()
+        os.replace(tmp_path, self.db_path)
+        print(f'\nLibrary: {self.n_images:,} images in {perf_counter() - start:.1f}s')
+
+
+    def _write_files(self):
+        # every file is the same small png; /serve only needs them to exist
+        buf = io.BytesIO()
+        Image.new('RGB', (320, 240), (90, 120, 150)).save(buf, 'PNG')
+        data = buf.getvalue()
+        for i in range(self.n_files):
+            directory, filename = self.path(i)
+            path = os.path.join(directory, filename)
+            if not os.path.isfile(path):
+                os.makedirs(directory, exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+
+
+def write_configs(work_dir: str, library: Library, port: int) -> str:
+    path = os.path.join(work_dir, 'configs.toml')
+    with open(path, 'w') as f:
+        f.write(f'root_path = {json.dumps(library.media_root)}\n')
+        f.write(f'db_path = {json.dumps(library.db_path)}\n')
+        f.write(f'web_media_roots = [{json.dumps(library.media_root)}]\n')
+        f.write(f'thumbnail_dir = {json.dumps(os.path.join(work_dir, "thumbnails"))}\n')
+        f.write('sqlite_wal = true\n')
+        f.write('allow_file_upload_search = false\n') # never load the model
+        f.write('host = "127.0.0.1"\n')
+        f.write(f'port = {port}\n')
+        f.write('debug = false\n')
+    return path
+
+
+def start_server(configs_path: str, port: int, gunicorn_workers: int, threads: int, log_path: str) -> subprocess.Popen:
+    """web.py's own server (threaded), or gunicorn with `gunicorn_workers` workers of `threads` threads each."""
+    if gunicorn_workers:
+        cmd = [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(gunicorn_workers), '--threads', str(threads), 'web:flask_app']
+    else:
+        cmd = [sys.executable, 'web.py']
+    env = dict(os.environ, TAGGER_CONFIGS=configs_path, PYTHONUNBUFFERED='1')
+    with open(log_path, 'w') as log:
+        server = subprocess.Popen(cmd, cwd=make_path(), env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = perf_counter() + 120
+    while perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with {server.returncode}, see {log_path}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/top_tags')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return server
+        except OSError:
+            pass
+        sleep(0.25)
+    server.terminate()
+    raise RuntimeError(f'Server did not start, see {log_path}')
+
+
+class User:
+    """One browser: a connection, the ETags it has seen, and where it is in its current search.
+
+    Requests are sent back to back with no think time, so `concurrency` users keep that many
+    requests in flight.
+    """
+    def __init__(self, library: Library, port: int, mix: dict, rnd: random.Random):
+        self.library = library
+        self.port = port
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.rnd = rnd
+        self.conn = None
+        self.etags: dict[str, str] = {}
+        self.cursor = None # next page of the last search
+        self.tag_ids = None # of the last search
+        self.image_ids: list[int] = [] # from the last page of results
+
+
+    def request(self, method: str, url: str, body: dict=None) -> tuple[int, dict | None]:
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = {'Accept-Encoding': 'gzip, br'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        elif url in self.etags:
+            headers['If-None-Match'] = self.etags[url]
+        try:
+            self.conn.request(method, url, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+
+        if resp.getheader('ETag') and resp.status == 200:
+            self.etags[url] = resp.getheader('ETag')
+        if resp.status == 200 and resp.getheader('Content-Type') == 'application/json' and not resp.getheader('Content-Encoding'):
+            return resp.status, json.loads(data)
+        return resp.status, None
+
+
+    def popular_tag_ids(self, n: int) -> list[int]:
+        # the gallery's top and cloud tags make popular tags the usual starting point
+        tags = self.library.general_tag_ids
+        return list({tags[min(int(self.rnd.paretovariate(1.2)) - 1, len(tags) - 1)] for _ in range(n)})
+
+
+    def search_w_tags(self):
+        if self.cursor and self.rnd.random() < 0.5:
+            params = {'general_tag_ids': self.tag_ids, 'cursor': self.cursor, 'per_page': 25}
+        else:
+            self.tag_ids = self.popular_tag_ids(self.rnd.choice([1, 1, 2, 3]))
+            params = {'general_tag_ids': self.tag_ids, 'cursor': '', 'per_page': 25}
+        status, data = self.request('GET', f'/search_w_tags?{urlencode(params, doseq=True)}')
+        if data:
+            self.cursor = data.get('cursor')
+            self.image_ids = [row['image_id'] for row in data['results'] if 'image_id' in row] or self.image_ids
+        return status
+
+
+    def random_search_w_tags(self):
+        params = {'general_tag_ids': self.popular_tag_ids(self.rnd.choice([0, 1, 2])), 'seed': '', 'per_page': 25}
+        status, data = self.request('GET', f'/random_search_w_tags?{urlencode(params, doseq=True)}')
+        if data:
+            self.image_ids = [row['image_id'] for row in data['results'] if 'image_id' in row] or self.image_ids
+        return status
+
+
+    def top_tags(self):
+        params = {'expOption': self.rnd.choice('GSQXN'), 'tagType': self.rnd.choice('GGGC')}
+        return self.request('GET', f'/top_tags?{urlencode(params)}')[0]
+
+
+    def cloud_tags(self):
+        params = {'expOption': self.rnd.choice('GSQXN'), 'tagType': self.rnd.choice('GGGC')}
+        return self.request('GET', f'/cloud_tags?{urlencode(params)}')[0]
+
+
+    def tags_by_letter(self):
+        return self.request('GET', f'/tags_by_letter?letter={self.rnd.choice(self.library.letters)}')[0]
+
+
+    def serve(self):
+        directory, filename = self.library.path(self.rnd.randrange(self.library.n_files))
+        return self.request('GET', f'/serve?{urlencode({"p": os.path.join(directory, filename)})}')[0]
+
+
+    def applyTagChanges(self):
+        # as in the gallery: select some results, read their common tags, then add or remove one
+        image_ids = self.rnd.sample(self.image_ids, min(len(self.image_ids), self.rnd.randint(1, 5))) if self.image_ids else [self.rnd.randint(1, self.library.n_images)]
+        _, common = self.request('GET', f'/api/selection?{urlencode({"selected_ids": image_ids}, doseq=True)}')
+        tag_ids = [row['tag_id'] for row in common or []]
+        if tag_ids and self.rnd.random() < 0.5:
+            tag_ids.remove(self.rnd.choice(tag_ids))
+        else:
+            tag_ids.append(self.rnd.choice(self.library.general_tag_ids))
+        return self.request('POST', '/api/applyTagChanges', body={'image_ids': image_ids, 'tag_ids': tag_ids, 'text_tags': []})[0]
+
+
+    def run(self, stop: threading.Event, record):
+        while not stop.is_set():
+            kind = self.rnd.choices(self.kinds, self.weights)[0]
+            start = perf_counter()
+            try:
+                status = getattr(self, kind)()
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+            record(kind, perf_counter() - start, status)
+
+
+def run_level(library: Library, port: int, mix: dict, concurrency: int, duration: float, warmup: float, seed: int) -> dict:
+    """`concurrency` users for `warmup` + `duration` seconds; only the last `duration` seconds are recorded."""
+    timings: dict[str, list[float]] = {kind: [] for kind in mix}
+    statuses: dict[str, dict] = {kind: {} for kind in mix}
+    lock = threading.Lock()
+    recording = threading.Event()
+
+    def record(kind: str, seconds: float, status):
+        if recording.is_set():
+            with lock:
+                timings[kind].append(seconds)
+                statuses[kind][status] = statuses[kind].get(status, 0) + 1
+
+    stop = threading.Event()
+    users = [User(library, port, mix, random.Random(f'{seed}-{concurrency}-{i}')) for i in range(concurrency)]
+    threads = [threading.Thread(target=user.run, args=(stop, record), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    sleep(warmup)
+    recording.set()
+    start = perf_counter()
+    sleep(duration)
+    recording.clear()
+    elapsed = perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    def summary(samples: list[float], status_counts: dict) -> dict:
+        samples = sorted(samples)
+        return {
+            'count': len(samples),
+            'errors': sum(n for status, n in status_counts.items() if not (isinstance(status, int) and status < 400)),
+            'per_second': round(len(samples) / elapsed, 2),
+            'p50_ms': round(1000 * percentile(samples, 0.50), 3),
+            'p95_ms': round(1000 * percentile(samples, 0.95), 3),
+            'p99_ms': round(1000 * percentile(samples, 0.99), 3),
+            'max_ms': round(1000 * samples[-1], 3) if samples else 0.0,
+            'statuses': {str(status): n for status, n in status_counts.items()},
+        }
+
+    all_statuses = {}
+    for status_counts in statuses.values():
+        for status, n in status_counts.items():
+            all_statuses[status] = all_statuses.get(status, 0) + n
+    return {
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'endpoints': {kind: summary(timings[kind], statuses[kind]) for kind in mix},
+        'total': summary([t for samples in timings.values() for t in samples], all_statuses),
+    }
+
+
+def print_level(result: dict):
+    print(f'\nConcurrency {result["concurrency"]}, {result["seconds"]:.1f}s')
+    print(f'  {"endpoint":<22}{"requests":>9}{"errors":>8}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, row in [*result['endpoints'].items(), ('total', result['total'])]:
+        print(f'  {name:<22}{row["count"]:>9,}{row["errors"]:>8,}{row["per_second"]:>9.1f}{row["p50_ms"]:>10.1f}{row["p95_ms"]:>10.1f}{row["p99_ms"]:>10.1f}{row["max_ms"]:>10.1f}')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Load test the web app against a generated library. No model is loaded.')
+  parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'tagger-loadtest'), help='generated library, configs and server log (default: %(default)s)')
+  parser.add_argument('--images', type=int, default=50_000, help='images in the generated library (default: %(default)s)')
+  parser.add_argument('--tags-per-image', type=int, default=20, help='general tags on each image (default: %(default)s)')
+  parser.add_argument('--files', type=int, default=2_000, help='images which get a file on disk, for /serve (default: %(default)s)')
+  parser.add_argument('--concurrency', default='1,4,16', help='comma separated numbers of concurrent users, one run each (default: %(default)s)')
+  parser.add_argument('--duration', type=float, default=20.0, help='recorded seconds per run (default: %(default)s)')
+  parser.add_argument('--warmup', type=float, default=3.0, help='unrecorded seconds before each run (default: %(default)s)')
+  parser.add_argument('--mix', help='request weights, e.g. search_w_tags=5,serve=1 (default: ' + ','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items()) + ')')
+  parser.add_argument('--gunicorn', type=int, default=0, metavar='WORKERS', help='serve with gunicorn and this many workers, rather than web.py')
+  parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker (default: %(default)s)')
+  parser.add_argument('--port', type=int, help='default: any free port')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--json', metavar='PATH', help='also write the results here')
+  args = parser.parse_args()
+
+  mix = DEFAULT_MIX
+  if args.mix:
+    mix = {}
+    for item in args.mix.split(','):
+      kind, _, weight = item.partition('=')
+      if kind not in DEFAULT_MIX:
+        parser.error(f'Unknown request kind {kind!r}, expected one of {list(DEFAULT_MIX)}')
+      mix[kind] = float(weight or 1)
+
+  os.makedirs(args.work_dir, exist_ok=True)
+  library = Library(args.work_dir, args.images, args.tags_per_image, args.files, args.seed)
+  library.build()
+
+  port = args.port or free_port()
+  configs_path = write_configs(args.work_dir, library, port)
+  log_path = os.path.join(args.work_dir, 'server.log')
+  server = start_server(configs_path, port, args.gunicorn, args.threads, log_path)
+  print(f'Serving with {f"gunicorn, {args.gunicorn} workers x {args.threads} threads" if args.gunicorn else "web.py"} on port {port}, log in {log_path}')
+
+  results = []
+  try:
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+      result = run_level(library, port, mix, concurrency, args.duration, args.warmup, args.seed)
+      print_level(result)
+      results.append(result)
+  finally:
+    server.terminate()
+    server.wait()
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({
+        'images': args.images,
+        'tags_per_image': args.tags_per_image,
+        'server': f'gunicorn -w {args.gunicorn} --threads {args.threads}' if args.gunicorn else 'web.py',
+        'mix': mix,
+        'runs': results,
+      }, f, indent=2)
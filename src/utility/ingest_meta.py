@@ -0,0 +1,25 @@
+import os,sys
+from configs import TaggerConfigs, configs
+from db import ImageDb
+from metadata import ExifToolPool, ingest_image_meta
+
+
+if __name__ == '__main__':
+
+  # Open database
+  me_configs: TaggerConfigs = configs
+  if not os.path.exists(me_configs.db_path):
+      print(f"Can't open database: '{me_configs.db_path}'")
+      exit()
+
+  me_db: ImageDb = ImageDb(me_configs.db_path, me_configs.sql_echo, wal=me_configs.sqlite_wal, busy_timeout=me_configs.sqlite_busy_timeout)
+  me_db.init_tagging() # creates the metadata tables in older databases
+
+  pool = ExifToolPool(me_configs.exiftool_processes)
+  try:
+    count = ingest_image_meta(me_db, pool, me_configs.meta_fields)
+  finally:
+    pool.close()
+  print(f"Stored metadata for {count} images")
+
+  me_db.close()
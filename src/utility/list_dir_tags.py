@@ -17,17 +17,13 @@ def confirm(msg):
 if __name__ == '__main__':
   
   # Verify and fetch command line arguments
-  argc = len(sys.argv)
-  #print(f"{argc} {sys.argv}")
-  if (argc < 2):
-    print("python list_dir_tag.py folder")
+  subtree = "-s" in sys.argv[1:]
+  args = [arg for arg in sys.argv[1:] if arg != "-s"]
+  if len(args) < 1:
+    print("Missing folder")
+    print("python list_dir_tags.py [-s] folder")
     exit()
-
-  if argc < 2:
-      print("Missing folder")
-      print("python list_dir_tag.py folder")
-      exit()
-  target = sys.argv[1]
+  target = args[0]
 
   # Open database  
   me_configs: TaggerConfigs = configs
@@ -38,20 +34,11 @@ if __name__ == '__main__':
   me_db: ImageDb = ImageDb(me_configs.db_path, me_configs.sql_echo)
 
   # Target folder must already be in database
-  sql = f'select directory_id from directory where directory = "{target}"'
-  results = me_db._run_query(sql)
-  #print(f"count: {len(results)}")
-  if (len(results) != 1):
+  if not me_db.get_folder_image_ids(target, subtree):
     print("Target folder must have already been processed by tagger.py")
     exit()
 
-  dirid = list(results[0].values())[0]
-  
-  sql = f"select distinct(tag_name) from view_tags_for_images where image_id in (select image_id from image where directory_id={dirid}) order by tag_name"
-  results = me_db._run_query(sql)
-  outstr = ""
-  for elem in results:
-      outstr += list(elem.values())[0] + ", "
-  print(outstr)
+  results = me_db.get_folder_tag_names(target, subtree)
+  print(", ".join(results))
   me_db.close()
   exit()
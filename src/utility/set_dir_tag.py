@@ -17,31 +17,20 @@ def confirm(msg):
 if __name__ == '__main__':
   
   # Verify and fetch command line arguments
-  argc = len(sys.argv)
-  #print(f"{argc} {sys.argv}")
-  if (argc < 2):
-    print("python set_dir_tag.py [-r] tag folder")
+  usage = "python set_dir_tag.py [-r] [-s] tag folder"
+  isreverse = "-r" in sys.argv[1:]
+  subtree = "-s" in sys.argv[1:]
+  args = [arg for arg in sys.argv[1:] if arg not in ("-r", "-s")]
+  if len(args) < 1:
+    print("Missing tag")
+    print(usage)
     exit()
-
-  isreverse = sys.argv[1] == "-r"
-  if isreverse:
-    if argc < 3:
-        print("Missing tag")
-        print("python set_dir_tag.py [-r] tag folder")
-        exit()
-    if argc < 4:
-        print("Missing folder")
-        print("python set_dir_tag.py [-r] tag folder")
-        exit()
-    tag = sys.argv[2]
-    target = sys.argv[3]
-  else:
-    if argc < 3:
-        print("Missing folder")
-        print("python set_dir_tag.py [-r] tag folder")
-        exit()
-    tag = sys.argv[1]
-    target = sys.argv[2]
+  if len(args) < 2:
+    print("Missing folder")
+    print(usage)
+    exit()
+  tag = args[0]
+  target = args[1]
 
   # Open database  
   me_configs: TaggerConfigs = configs
@@ -52,19 +41,10 @@ if __name__ == '__main__':
   me_db: ImageDb = ImageDb(me_configs.db_path, me_configs.sql_echo)
 
   # Target folder must already be in database
-  sql = f'select directory_id from directory where directory = "{target}"'
-  results = me_db._run_query(sql)
-  #print(f"count: {len(results)}")
-  if (len(results) != 1):
-    target = target.rstrip("/") # handling trailing slash
-    sql = f'select directory_id from directory where directory = "{target}"'
-    results = me_db._run_query(sql)
-    if (len(results) != 1):
-      print(f'Target folder "{target}" must have already been processed by tagger.py')
-      exit()
-
-  dirid = list(results[0].values())[0]
-  #print(f"directory id: {dirid}")
+  imageids = me_db.get_folder_image_ids(target, subtree)
+  if not imageids:
+    print(f'Target folder "{target}" must have already been processed by tagger.py')
+    exit()
 
   # Need the tag id for the tag: fetch or add    
   sql = f'select tag_id from tag where tag_name = "{tag}"'
@@ -88,9 +68,7 @@ if __name__ == '__main__':
 
   #print(f"tag_id : {tagid}")
 
-  sql = f"select count(image_id) from image where directory_id={dirid}"
-  results = me_db._run_query(sql)
-  imgcount = list(results[0].values())[0]
+  imgcount = len(imageids)
   if isreverse:
     if not confirm(f"About to remove tag '{tag}' from {imgcount} images."):
       exit()
@@ -98,22 +76,13 @@ if __name__ == '__main__':
     if not confirm(f"About to apply tag '{tag}' to {imgcount} images."):
       exit()
 
-  # For every file ALREADY IN THE DATABASE add the tag
-  for entry in os.listdir(target):
-    sql = f'select image_id from image where directory_id={dirid} and filename="{entry}"'
-    results = me_db._run_query(sql)
-    if (len(results) < 1):
-      print(f'Skipping: "{entry}"')
-      continue
-    imageid = list(results[0].values())[0]
-
-    if isreverse:
-        sql = f'delete from image_tag where image_id={imageid} and tag_id={tagid}'
-    else:
-        sql = f'insert or ignore into image_tag (image_id, tag_id, prob) values ({imageid},{tagid}, 1.0)'
-    me_db._run_query(sql)
+  # For every image ALREADY IN THE DATABASE add the tag
+  if isreverse:
+    sql = 'delete from image_tag where image_id = ? and tag_id = ?'
+  else:
+    sql = 'insert or ignore into image_tag (image_id, tag_id, prob) values (?, ?, 1.0)'
+  me_db.run_write_many(sql, [(imageid, tagid) for imageid in imageids])
     
-  print("Updating tag counts")
-  me_db.update_tag_counts() # update for changes, esp. for new tags
+  me_db.bump_generation()
     
   me_db.save_and_close()
@@ -0,0 +1,31 @@
+
+import os,sys
+from configs import TaggerConfigs, configs
+from db import ImageDb
+
+
+if __name__ == '__main__':
+
+  # Verify and fetch command line arguments
+  fix = "--fix" in sys.argv[1:]
+
+  # Open database
+  me_configs: TaggerConfigs = configs
+  if not os.path.exists(me_configs.db_path):
+      print(f"Can't open database: '{me_configs.db_path}'")
+      exit()
+
+  me_db: ImageDb = ImageDb(me_configs.db_path, me_configs.sql_echo)
+
+  results = me_db.verify_tag_counts()
+  for row in results:
+    print(f'{row.tag_id}: "{row.tag_name}" tag_count={row.tag_count} actual={row.actual}')
+  print(f"{len(results)} tag count(s) differ from image_tag")
+
+  if results and fix:
+    me_db.update_tag_counts()
+    me_db.save()
+    print("Tag counts recomputed")
+
+  me_db.close()
+  exit()
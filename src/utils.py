@@ -1,4 +1,6 @@
+import base64
 import hashlib
+import json
 import os
 from io import BytesIO
 from pathlib import Path
@@ -56,3 +58,54 @@ def clamp(val, default, min_, max_):
     if isinstance(val, list):
         return [max(min(v, max_), min_) for v in val]
     return max(min(val, max_), min_)
+
+
+def encode_cursor(key: tuple) -> str:
+    """Opaque, url-safe token for a keyset pagination key."""
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(token: str) -> tuple:
+    """The (directory, filename, image_id) key of an encode_cursor token. ValueError if it isn't one."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor: {token}') from e
+    if not isinstance(key, list) or len(key) != 3:
+        raise ValueError(f'Invalid cursor: {token}')
+    directory, filename, image_id = key
+    if not isinstance(directory, str) or not isinstance(filename, str) or type(image_id) is not int:
+        raise ValueError(f'Invalid cursor: {token}')
+    return tuple(key)
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x: int) -> int:
+    """splitmix64 finalizer"""
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def permuted_index(index: int, size: int, seed: int, rounds: int=4) -> int:
+    """Where `index` lands in a pseudo-random permutation of range(size) keyed by `seed`.
+
+    A balanced Feistel network over the smallest even-bit domain covering size, cycle-walking
+    until the result is back in range. Any slice of the permutation costs O(len(slice)).
+    """
+    if not 0 <= index < size:
+        raise IndexError(index)
+
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    half_mask = (1 << half_bits) - 1
+
+    x = index
+    while True:
+        left, right = x >> half_bits, x & half_mask
+        for r in range(rounds):
+            left, right = right, left ^ (_mix64((seed << 8) ^ (r << 56) ^ right) & half_mask)
+        x = (left << half_bits) | right
+        if x < size:
+            return x
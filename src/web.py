@@ -1,13 +1,12 @@
+import hashlib
 import json
-import mimetypes
 import os
 import logging
-from functools import lru_cache
-from time import perf_counter
+import sqlite3
+import struct
+from time import perf_counter, sleep
+from typing import BinaryIO
 import subprocess
-import exiftool
-import base64
-import pickle
 
 from flask import (
     Blueprint,
@@ -19,9 +18,10 @@ from flask import (
     request,
     send_file,
     Response,
+    stream_with_context,
     session,
 )
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import (
     BadRequest,
@@ -31,18 +31,21 @@ from werkzeug.exceptions import (
 )
 from werkzeug.security import safe_join
 
+from cache import EncodedCache, LruCache
 from configs import configs
+from db import ImageDb
 from db_flask import FlaskImageDb
+from db_writer import DbWriter, WriterImageDb
+from fs_verify import FsVerifier
+from jobs import JobManager
+from metadata import ExifToolPool
+from query_stats import QueryStats
 from tagger import Tagger
-from utils import clamp, get_sha256_from_bytesio, make_path
+from thumbnails import ThumbnailCache
+from utils import clamp, decode_cursor, encode_cursor, get_sha256_from_bytesio, make_path
 
 if configs.allow_file_upload_search:
-    from processor import process_images_from_imgs
-import threading
-import queue
-
-progress_queue = queue.Queue()
-
+    from inference import InferenceService
 bp = Blueprint('36g', __name__)
 
 
@@ -50,23 +53,134 @@ def get_filters() -> list[str]:
     return ['f_tag', 'f_general', 'f_sensitive', 'f_explicit', 'f_questionable']
 
 
-def app_process_images_from_path(img_path: str, page: int, per_page: int) -> dict:
+def get_meta_filters() -> tuple[tuple[str, str], ...]:
+    """The (field, value) pairs of any number of `meta=Field=Value` args, e.g. meta=Model=X100V."""
+    pairs = []
+    for arg in request.args.getlist('meta'):
+        field, sep, value = arg.partition('=')
+        if not sep or not field:
+            abort(400, description=f'Expected meta=field=value, got {arg!r}')
+        pairs.append((field, value))
+    return tuple(pairs)
+
+
+def not_modified(etag: str) -> Response:
+    rv = Response(status=304)
+    rv.set_etag(etag)
+    return rv
+
+
+def generation_json(build, cache_key: str=None):
+    """jsonify(build()), tagged with the DB generation.
+
+    The browser revalidates on every use; until something is written to the DB the answer is
+    a bodiless 304 and build() isn't run. With a `cache_key`, the serialized and compressed
+    body is also kept in current_app.json_cache for other clients, and the ETag names the key
+    as well, so it only ever validates a body built for that generation.
+    """
+    generation = current_app.db.get_generation()
+    etag = f'{cache_key}-g{generation}' if cache_key else f'g{generation}'
+    if etag in request.if_none_match:
+        rv = not_modified(etag)
+    elif cache_key:
+        bodies = current_app.json_cache.get(cache_key, generation, lambda: current_app.json.dumps(build()).encode())
+        encoding = max(current_app.json_cache.encodings, key=lambda encoding: request.accept_encodings[encoding])
+        if not request.accept_encodings[encoding]:
+            encoding = 'identity'
+        rv = Response(bodies[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            rv.content_encoding = encoding
+        rv.set_etag(etag)
+    else:
+        rv = jsonify(build())
+        rv.set_etag(etag)
+    if cache_key:
+        rv.vary.add('Accept-Encoding')
+    rv.cache_control.no_cache = True
+    return rv
+
+
+def send_media(file_path: str | BinaryIO, st: os.stat_result, etag: str, mimetype: str=None) -> Response:
+    """send_file() with a strong validator from the original file, cached by the browser for media_max_age."""
+    if etag in request.if_none_match:
+        rv = not_modified(etag)
+        rv.cache_control.max_age = configs.media_max_age
+        return rv
+    return send_file(file_path, mimetype=mimetype, etag=etag, last_modified=st.st_mtime, max_age=configs.media_max_age)
+
+
+def wants_ndjson() -> bool:
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def iter_json(rows, ndjson: bool=False, chunk_chars: int=64 * 1024):
+    """Encode `rows` as they are read, as a JSON array or as one JSON document per line (NDJSON).
+
+    Rows are gathered into chunks of about `chunk_chars`, so only one chunk of the body is in
+    memory at a time and the first one goes out before the query has been read to the end.
+    """
+    dumps = current_app.json.dumps
+    chunk = [] if ndjson else ['[']
+    size = 0
+    sep = ''
+    for row in rows:
+        s = dumps(row)
+        chunk.append(f'{s}\n' if ndjson else f'{sep}{s}')
+        sep = ','
+        size += len(s)
+        if size >= chunk_chars:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if not ndjson:
+        chunk.append(']')
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_json(rows) -> Response:
+    """A streamed response of `rows`: a JSON array, or NDJSON when the client asks for it."""
+    ndjson = wants_ndjson()
+    rv = Response(stream_with_context(iter_json(rows, ndjson)), mimetype='application/x-ndjson' if ndjson else 'application/json')
+    rv.vary.add('Accept')
+    return rv
+
+
+def tag_upload(file_image: FileStorage) -> tuple[dict, dict, dict, dict | None, str]:
+    """(rating_tags, char_tags, gen_tags, timings, source) for an upload.
+
+    An upload of an image already in the library reuses its stored tags, and a repeat
+    upload reuses the model's earlier output; only new uploads go through the model.
+    """
+    sha256 = get_sha256_from_bytesio(file_image.stream)
+
+    tags = current_app.db.get_tagger_tags_by_sha256(sha256, configs.min_general_tag_val, configs.min_character_tag_val)
+    if tags:
+        return *tags, None, 'library'
+
+    tags = current_app.upload_cache.get(sha256)
+    if tags:
+        return *tags, None, 'upload cache'
+
+    # decoded here, straight from the upload, so a bad file fails only this request
+    file_image.stream.seek(0)
+    try:
+        img = Image.open(file_image.stream)
+        img.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        abort(415, description='Not a readable image')
+
+    rating_tags, char_tags, gen_tags, timings = current_app.inference.tag(img)
+    current_app.upload_cache.put(sha256, (rating_tags, char_tags, gen_tags))
+    return rating_tags, char_tags, gen_tags, timings, 'model'
+
+
+def app_process_image(file_image: FileStorage, page: int, per_page: int) -> dict:
     i1 = perf_counter()
 
-    img = Image.open(img_path)
     filters = {key: 0.0 for key in get_filters()}
-    rating_tags, char_tags, gen_tags = process_images_from_imgs(
-        [img],
-        current_app.tagger.model,
-        current_app.tagger.transform,
-        current_app.tagger.torch_device,
-        current_app.tagger.tag_data,
-        configs.min_general_tag_val,
-        configs.min_character_tag_val,
-        by_idx=True,
-    )[0]
+    rating_tags, char_tags, gen_tags, timings, source = tag_upload(file_image)
     tags = [*char_tags, *gen_tags]
-    os.remove(img_path)
 
     i2 = perf_counter()
     f1 = i2 - i1
@@ -79,7 +193,8 @@ def app_process_images_from_path(img_path: str, page: int, per_page: int) -> dic
 
     image_count = current_app.db.get_image_count()
     message = '\n'.join([
-        f'Processing your image took {f1:.3f}s.',
+        f'Processing your image took {f1:.3f}s: {timings["queue_ms"]:.0f}ms queued, then {timings["inference_ms"]:.0f}ms in a batch of {timings["batch_size"]}.'
+        if timings else f'Processing your image took {f1:.3f}s, using the tags from the {source}.',
         f'We searched the tags of {image_count:,} images in {f2:.3f}s and found {tot_count:,} results.',
         '',
         f'Here are the tags for your uploaded image:',
@@ -90,7 +205,9 @@ def app_process_images_from_path(img_path: str, page: int, per_page: int) -> dic
     ])
     return {
         'message': message,
-        'results': results
+        'results': results,
+        'timings': timings,
+        'source': source,
     }
 
 
@@ -103,17 +220,10 @@ def search_w_file():
     if not file_image:
         abort(BadRequest)
 
-    sha256 = get_sha256_from_bytesio(file_image.stream)
-    ext = mimetypes.guess_extension(file_image.mimetype)
-
-    img_path = make_path('uploads', f'{sha256}.{ext}')
-    file_image.stream.seek(0)
-    file_image.save(img_path)
-
     page = 0
     per_page = 25
 
-    return jsonify(app_process_images_from_path(img_path, page, per_page))
+    return jsonify(app_process_image(file_image, page, per_page))
 
 
 @bp.route('/search_w_tags', methods=['GET'])
@@ -129,8 +239,14 @@ def search_w_tags():
     if not tags:
         return jsonify({'message': 'Try changing your filters.', 'result': [{}]})
 
+    folder = request.args.get('folder') or None # limits the search to this folder and those below it
+    meta = get_meta_filters()
+
+    if 'cursor' in request.args:
+        return search_w_tags_cursor(tags, filters, per_page, folder, meta)
+
     i1 = perf_counter()
-    results,tot_count = current_app.db.get_images_by_tag_ids(tags, filters['f_tag'], filters['f_general'], filters['f_sensitive'], filters['f_explicit'], filters['f_questionable'], page, per_page) #if tags else [],0
+    results,tot_count = current_app.db.get_images_by_tag_ids(tags, filters['f_tag'], filters['f_general'], filters['f_sensitive'], filters['f_explicit'], filters['f_questionable'], page, per_page, folder, meta) #if tags else [],0
     f1 = perf_counter() - i1
 
     image_count = current_app.db.get_image_count()
@@ -140,15 +256,39 @@ def search_w_tags():
         'tot_found': tot_count,
     })
 
+
+def search_w_tags_cursor(tags: list[int], filters: dict, per_page: int, folder: str=None, meta: tuple=None):
+    """Keyset-paginated search. An empty cursor starts from the beginning; the total is only counted then."""
+    token = request.args.get('cursor')
+    try:
+        after = decode_cursor(token) if token else None
+    except ValueError:
+        abort(400, description='Invalid cursor')
+
+    i1 = perf_counter()
+    results,last = current_app.db.get_images_by_tag_ids_after(tags, filters['f_tag'], filters['f_general'], filters['f_sensitive'], filters['f_explicit'], filters['f_questionable'], after, per_page, folder, meta)
+    tot_count = None
+    if after is None:
+        tot_count = len(current_app.db._search_image_ids(tags, filters['f_tag'], filters['f_general'], filters['f_sensitive'], filters['f_explicit'], filters['f_questionable'], folder, meta))
+    f1 = perf_counter() - i1
+
+    image_count = current_app.db.get_image_count()
+    found = f' and found {tot_count:,} results' if tot_count is not None else ''
+    return jsonify({
+        'message': f'We searched the tags of {image_count:,} images in {f1:.3f}s{found}.',
+        'results': results,
+        'tot_found': tot_count,
+        'cursor': encode_cursor(last) if last else None,
+    })
+
 @bp.route('/top_tags', methods=['GET'])
 def get_top_tags():
 
     choice1 = request.args.get('expOption') # general/sensitive/questionable/explicit
     choice2 = request.args.get('tagType') # general/character; future "artist"
 
-    results = current_app.db.get_top_tags(choice1,choice2)
-    return jsonify({
-    'results': results,
+    return generation_json(lambda: {
+        'results': current_app.db.get_top_tags(choice1,choice2),
     })
 
 @bp.route('/second_top_tags', methods=['GET'])
@@ -187,13 +327,32 @@ def tags_by_letter():
         'results': results,
     })
 
-@bp.route('/letters_with_tags', methods=['GET'])
-def letters_with_tags():
-    results = current_app.db.get_letters_with_tags()
+@bp.route('/tags/autocomplete', methods=['GET'])
+def tags_autocomplete():
+    q = request.args.get('q', '')
+    limit = clamp(request.args.get('limit', type=int), 20, 1, 200)
+    tag_type_id = request.args.get('tag_type_id', type=int) # missing: all tag types
+    results = current_app.db.search_tag_names(q, limit, tag_type_id)
     return jsonify({
+        'q': q,
         'results': results,
     })
 
+@bp.route('/folders', methods=['GET'])
+def folders():
+    parent_id = request.args.get('parent_id', type=int) # missing: the top-level folders
+    results = current_app.db.get_child_directories(parent_id)
+    return jsonify({
+        'parent_id': parent_id,
+        'results': results,
+    })
+
+@bp.route('/letters_with_tags', methods=['GET'])
+def letters_with_tags():
+    return generation_json(lambda: {
+        'results': current_app.db.get_letters_with_tags(),
+    })
+
 @bp.route('/all_images', methods=['GET'])
 def all_images():
     """An endpoint for testing demo.html only.
@@ -204,18 +363,27 @@ def all_images():
     if not current_app.debug:
         raise ValueError('Not in debug mode.')
 
-    results = current_app.db._get_all_images()
+    rows = current_app.db.iter_all_images()
+    if wants_ndjson():
+        return stream_json(rows)
 
     result_js_path = make_path('..', 'demo', 'results.js')
-    with open(result_js_path, mode='w') as f:
-        # I know.
-        s = 'const results = ' + json.dumps(results) + ';'
-        f.write(s)
+
+    def stream():
+        # written alongside the response, and only put in place once all of it has been sent
+        tmp_path = f'{result_js_path}.tmp'
+        with open(tmp_path, mode='w') as f:
+            f.write('const results = ')
+            for chunk in iter_json(rows):
+                f.write(chunk)
+                yield chunk
+            f.write(';')
+        os.replace(tmp_path, result_js_path)
 
     # You can also use bash with this one liner...
     # echo -n "const results = " > ~/Desktop/results.js && curl -s http://127.0.0.1:8000/all_images >> ~/Desktop/results.js && echo ";" >> ~/Desktop/results.js
 
-    return jsonify(results)
+    return Response(stream_with_context(stream()), mimetype='application/json')
 
 
 @bp.route('/')
@@ -231,42 +399,49 @@ def current_selection():
     #print('current_selection')
     selected_ids = request.args.getlist('selected_ids', type=int)
     #print(selected_ids)
+    partial = request.args.get('partial', default=0, type=int) # also tags on only some of the images
     if len(selected_ids) == 0:
         return jsonify([])
-    results = current_app.db.get_common_tags(selected_ids,0,0.0)
+    results = current_app.db.get_common_tags(selected_ids,0,0.0,include_partial=bool(partial))
     return jsonify(results)
 
-@bp.route('/api/applyTagChanges', methods=["GET"])
+@bp.route('/api/applyTagChanges', methods=["POST"])
 def applyTagChanges():
-    #print('applyTagChanges')
-    image_ids = request.args.getlist('image_ids', type=int)
-    tag_ids = request.args.getlist('tag_ids', type=int)
-    text_tags = request.args.getlist('text_tags')
+    # body: {"image_ids": [...], "tag_ids": [...], "text_tags": [...]}
+    # tag_ids is the complete set of tags the images should have in common afterwards
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    try:
+        image_ids = [int(i) for i in body.get('image_ids', [])]
+        tag_ids = [int(t) for t in body.get('tag_ids', [])]
+        text_tags = [str(t) for t in body.get('text_tags', [])]
+    except (TypeError, ValueError):
+        abort(400)
 
     blah = current_app.db.get_common_tags(image_ids,0,0.0)
     old_tag_ids = [row["tag_id"] for row in blah]
     
-    #print(f"ATC old_tag_ids: {old_tag_ids}")
-    #print(f"ATC new_tag_ids: {tag_ids}")
-    
     tags_to_delete = list(set(old_tag_ids) - set(tag_ids))
-    #print(f'ATC tags to delete: {tags_to_delete}')
-    
-    if len(tags_to_delete) > 0:
-        current_app.db.delete_tags(image_ids, tags_to_delete)
-
     tags_to_add = list(set(tag_ids) - set(old_tag_ids))
-    #print(f'ATC tags to add: {tags_to_add}')
 
-    if len(tags_to_add) > 0:
-        #newdb = FlaskImageDb(configs.db_path, sql_echo=configs.sql_echo)        
-        current_app.db.add_tags(image_ids, tags_to_add)
-        #newdb.close()
+    # TODO text tags are created as FUTURE
+    counts = current_app.db_writer.call(ImageDb.apply_tag_changes, image_ids, tags_to_add, tags_to_delete, text_tags)
+    return jsonify(counts)
 
-    #print(f'ATC text tags: {text_tags}')
-    if len(text_tags) > 0:
-        current_app.db.add_possibly_new_tags(image_ids, text_tags, 32) # TODO last parameter is hardcoded as FUTURE
-    return jsonify([])
+@bp.route('/api/stats', methods=["GET"])
+def stats():
+    return jsonify({
+        'search_cache': current_app.db.search_cache.stats(),
+        'writer': current_app.db_writer.stats(),
+        'queries': current_app.db.query_stats.stats() if current_app.db.query_stats else None,
+        'thumbnails': current_app.thumbnails.stats(),
+        'json_cache': current_app.json_cache.stats(),
+        'inference': current_app.inference.stats() if current_app.inference else None,
+        'upload_cache': current_app.upload_cache.stats(),
+        'exiftool': current_app.exiftool.stats(),
+        'jobs': [job.snapshot() for job in current_app.jobs.jobs() if not job.finished],
+    })
 
 @bp.route('/api/getMRAtags', methods=["GET"])
 def getMRAtags():
@@ -276,22 +451,12 @@ def getMRAtags():
 @bp.route('/api/removeImage', methods=["GET"])
 def removeImage():
     image_ids = request.args.get('image_ids')
-    current_app.db.remove_image(image_ids)
+    current_app.db_writer.call(ImageDb.remove_image, image_ids)
     return jsonify("")
 
-@lru_cache(maxsize=1)
-def get_all_tags():
-    tags = current_app.db.get_tags()
-    if not tags:
-        return jsonify([])
-    return jsonify([{'tag_id': tag[0], 'tag_name': tag[1], 'tag_type_name': tag[2]} for tag in tags])
-
 @bp.get('/tags')
 def tags():
-    @lru_cache
-    def _tags():
-        return jsonify(current_app.db.get_tags())
-    return _tags()
+    return generation_json(current_app.db.get_tags, cache_key='tags')
 
 @bp.errorhandler(NotFound)
 def file_not_found(e):
@@ -313,7 +478,100 @@ def serve():
         #print(f"Not found {file_path}")
         abort(404, description=file_path)  # TODO was NotFound, results in LookupError exception
 
-    return send_file(file_path)
+    st = os.stat(file_path)
+    return send_media(file_path, st, f'{st.st_size:x}-{st.st_mtime_ns:x}')
+
+@bp.route('/thumb')
+def thumb():
+    image_id = request.args.get('id', type=int)
+    if image_id is None:
+        abort(400)
+
+    file_path = getPathForImageId(image_id)
+    if file_path is None:
+        abort(404, description=str(image_id))
+
+    if not file_path.startswith(configs.web_media_roots):
+        abort(403, description=file_path)
+
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        abort(404, description=file_path)
+
+    # the thumbnail's name is a hash of the original's path, mtime and size; its own mtime changes on every hit
+    thumb_path = current_app.thumbnails.thumb_path(file_path, st)
+    etag = os.path.splitext(os.path.basename(thumb_path))[0]
+    if etag in request.if_none_match:
+        return send_media(thumb_path, st, etag)
+
+    # opened here, so an eviction before it is sent can't fail the request
+    thumb_file = current_app.thumbnails.open(file_path)
+    if thumb_file is None:
+        # unreadable by PIL; the browser may still manage
+        return send_media(file_path, st, f'{st.st_size:x}-{st.st_mtime_ns:x}')
+
+    return send_media(thumb_file, st, etag, mimetype=current_app.thumbnails.mimetype)
+
+@bp.route('/thumbs')
+def thumbs():
+    """Thumbnails of up to 1,000 images in one response, for a whole results page.
+
+    `ids` is a comma-separated list of image ids. The body is a record per id: the image id and
+    the thumbnail's length in bytes, as big-endian unsigned 32-bit ints, then the thumbnail.
+    Records come as thumbnails are ready, not in request order. A length of 0 means there is
+    no thumbnail for that id; /thumb?id= may still have something to show.
+    """
+    try:
+        image_ids = list(dict.fromkeys(int(image_id) for image_id in request.args.get('ids', '').split(',') if image_id))
+    except ValueError:
+        abort(400, description='ids must be comma-separated image ids')
+    if len(image_ids) > 1_000:
+        abort(400, description='At most 1,000 ids')
+
+    # paths come from the db, never from the client
+    src_ids: dict[str, list[int]] = {}
+    keys = []
+    paths = current_app.db.get_image_paths(image_ids) if image_ids else {}
+    for image_id, file_path in paths.items():
+        if not file_path.startswith(configs.web_media_roots):
+            continue
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        src_ids.setdefault(file_path, []).append(image_id)
+        keys.append(f'{image_id}:{os.path.basename(current_app.thumbnails.thumb_path(file_path, st))}')
+    found = {image_id for ids in src_ids.values() for image_id in ids}
+    not_found = [image_id for image_id in image_ids if image_id not in found]
+    keys += [f'{image_id}:' for image_id in not_found]
+
+    etag = hashlib.sha1('\n'.join(sorted(keys)).encode()).hexdigest()
+    if etag in request.if_none_match:
+        rv = not_modified(etag)
+        rv.cache_control.max_age = configs.media_max_age
+        return rv
+
+    def stream():
+        for image_id in not_found:
+            yield struct.pack('>II', image_id, 0)
+        for src_path, thumb_path in current_app.thumbnails.get_many(list(src_ids)):
+            data = b''
+            if thumb_path:
+                try:
+                    f = open(thumb_path, 'rb')
+                except FileNotFoundError:
+                    f = current_app.thumbnails.open(src_path) # evicted since, render it again
+                if f:
+                    with f:
+                        data = f.read()
+            for image_id in src_ids[src_path]:
+                yield struct.pack('>II', image_id, len(data)) + data
+
+    rv = Response(stream_with_context(stream()), mimetype='application/octet-stream', headers={'X-Thumbnail-Type': current_app.thumbnails.mimetype})
+    rv.set_etag(etag)
+    rv.cache_control.max_age = configs.media_max_age
+    return rv
 
 @bp.route('/dupl_images')
 def dupl_images():
@@ -321,11 +579,11 @@ def dupl_images():
     # NOTE: essentially requires sha256 values to have been calculated by the tagger.
     # NOTE: also used by 'dupl auto del' to fetch initial AND final results.
     # TODO: currently assumes only pairs of duplicates, will behave badly if more than 2 matches occur
-    res = current_app.db.get_sha_dupls()
-    return res
+    return stream_json(current_app.db.iter_sha_dupls())
 
-def auto_del_dupl_task(dupls):
-    with flask_app.app_context():
+def auto_del_dupl_task(job, app, dupls):
+    with app.app_context():
+        removals = []
         newdupls = []
         index = 0
         maxcount = len(dupls)
@@ -335,7 +593,7 @@ def auto_del_dupl_task(dupls):
             file2ok = os.path.isfile(dupls[index+1]["image_path"])
             if dupls[index]["tags"] == dupls[index+1]["tags"]:
                 todelete = dupls[index]["image_id"] if file2ok else dupls[index+1]["image_id"]
-                current_app.db.remove_image(todelete)
+                removals.append(current_app.db_writer.submit(ImageDb.remove_image, todelete))
             else:
                 # TODO unnecessary?
                 newdupls.append(dupls[index])
@@ -344,18 +602,21 @@ def auto_del_dupl_task(dupls):
             index += 2
 
             if (index % 50 == 0):            
-                progress = int((index / maxcount) * 100)
-                progress_queue.put(progress)
+                job.progress(index, maxcount)
+                job.raise_if_cancelled() # removals queued so far still go through
             
             if index < len(dupls) and dupls[index]["sha256"] == dupls[index-1]["sha256"]:
                 print("dupl_images_auto_delete: More than two duplications encountered, punting")
-                progress_queue.put("DONE")
-                return
-                
-    progress_queue.put("DONE")
+                break
+
+        # queued back to back, so the writer commits these in a few large transactions
+        for removal in removals:
+            removal.result()
+        job.progress(maxcount, maxcount)
+    return {'removed': len(removals)}
     
     
-@bp.route('/dupl_images_auto_del')
+@bp.route('/dupl_images_auto_del', methods=["GET", "POST"])
 def dupl_images_auto_delete():
     # Reconcile moved images. 
     # Find all "duplicate" images [based on equal sha256 values]. Go through those duplicates,
@@ -369,67 +630,75 @@ def dupl_images_auto_delete():
 
     dupls = current_app.db.get_sha_dupls()
 
-    thread = threading.Thread(target=auto_del_dupl_task, args=([dupls]))
-    thread.start()
-    return jsonify({"status": "started"})
+    job = current_app.jobs.submit('dupl_images_auto_del', auto_del_dupl_task, current_app._get_current_object(), dupls)
+    return jsonify({"status": "started", "job_id": job.id})
 
 @bp.route('/keep_tags')
 def keep_tags():
     src = request.args.get('from')
     dst = request.args.get('to')
-    current_app.db.keep_tags(src, dst)    
+    current_app.db_writer.call(ImageDb.keep_tags, src, dst)
     return jsonify("")
 
-def remove_deleted_task():
+def remove_deleted_task(job, app):
     # potentially long-running task: remove deleted files from the database
-    with flask_app.app_context():
-        maxcount = current_app.db.get_image_count()
-        current_app.db.clear_mark()
-        rp = configs.root_path
-        i = 0
-        batch = []
-        sql = "update image set mark = 1 where directory_id = ? and filename=?"
-        for currdir, _, files in os.walk(rp):
-            dirid = current_app.db.mark_dir(currdir)
-            if len(dirid) < 1:
-                continue # directory not in database, new, can't be missing
-            for file in files:
-                batch.append((dirid[0]["directory_id"], file))
-                #current_app.db.mark_file(dirid[0]["directory_id"], file)
-                i += 1
-                if i % 1000 == 0:
-                    progress = int((i / maxcount) * 100)
-                    progress_queue.put(progress)
-                    #print(i)
-                    current_app.db.mark_fileB(batch)
-                    #current_app.db.run_query_many(sql, params=batch, commit=True)
-                    batch.clear()
-
-        #print(i)
-        if batch:
-            current_app.db.mark_fileB(batch)
-            #current_app.db.run_query_many(sql_string, params=batch, commit=True)
-        
-        current_app.db.del_unmarked()
-    progress_queue.put("DONE")
+    def progress(done, total):
+        job.progress(done, total)
+        job.raise_if_cancelled() # images already removed stay removed
+
+    with app.app_context():
+        verifier = FsVerifier(current_app.db, workers=configs.verify_workers, batch_size=configs.sql_insert_batch_size, progress=progress, writer=current_app.db_writer)
+        report = verifier.run(root_path=configs.root_path)
+        print(report.summary())
+        return {'deleted_images': report.deleted_images, 'deleted_directories': report.deleted_directories}
     
 @bp.route('/remove_deleted', methods=["POST"])
 def remove_deleted():
-    thread = threading.Thread(target=remove_deleted_task)
-    thread.start()
-    return jsonify({"status": "started"})
+    job = current_app.jobs.submit('remove_deleted', remove_deleted_task, current_app._get_current_object())
+    return jsonify({"status": "started", "job_id": job.id})
+
+def get_job(job_id: int):
+    job = current_app.jobs.get(job_id)
+    if job is None:
+        abort(404, description=f'No job {job_id}')
+    return job
+
+@bp.route('/jobs')
+def jobs():
+    return jsonify({'results': [job.snapshot() for job in current_app.jobs.jobs()]})
+
+@bp.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    return jsonify(get_job(job_id).snapshot())
+
+@bp.route('/jobs/<int:job_id>/cancel', methods=["POST"])
+def job_cancel(job_id):
+    job = get_job(job_id)
+    job.cancel()
+    return jsonify(job.snapshot())
+
+@bp.route('/jobs/<int:job_id>/events')
+def job_events(job_id):
+    """Server-sent events: the job's snapshot whenever it changes, then a 'done' event once it has finished."""
+    job = get_job(job_id)
 
-@bp.route('/progress')
-def progress():
     def event_stream():
+        version = -1
         while True:
-            msg = progress_queue.get()
-            if msg == "DONE":
-                yield "event: done\ndata: complete\n\n"
-                break
-            yield f"data: {msg}\n\n"
+            snapshot = job.snapshot()
+            if snapshot['state'] in ('done', 'failed', 'cancelled'):
+                yield f"event: done\ndata: {json.dumps(snapshot)}\n\n"
+                return
+            if snapshot['version'] != version:
+                version = snapshot['version']
+                yield f"data: {json.dumps(snapshot)}\n\n"
+            else:
+                yield ": keepalive\n\n" # notices a closed connection
+            # progress can come many times a second; a few updates a second is plenty
+            job.wait(version, timeout=15)
+            sleep(0.25)
 
-    return Response(event_stream(), mimetype="text/event-stream")
+    return Response(event_stream(), mimetype="text/event-stream", headers={'Cache-Control': 'no-cache'})
 
 def getPathForImageId(image_id):
     results = current_app.db.get_image_path(image_id)
@@ -456,7 +725,7 @@ def delImage():
     rmres = subprocess.run(["rm", "-f", file_path])
     if (rmres.returncode != 0):
         abort(423);
-    current_app.db.remove_image(image_id)
+    current_app.db_writer.call(ImageDb.remove_image, image_id)
     return jsonify("")
 
 @bp.route('/api/editTag')
@@ -465,7 +734,7 @@ def edit_tag():
     tag_name = request.args.get('name')
     tag_class = request.args.get('class')
     try:
-      current_app.db.edit_tag(tag_id, tag_name, tag_class)
+      current_app.db_writer.call(ImageDb.edit_tag, tag_id, tag_name, tag_class)
     except ValueError as eve:
       return jsonify({"message":str(eve)}), 400
     return jsonify("")
@@ -474,20 +743,36 @@ def edit_tag():
 def remove_tag():
     tag_id = request.args.get('tag_id')
     try:
-      current_app.db.remove_tag(tag_id)
+      current_app.db_writer.call(ImageDb.remove_tag, tag_id)
     except sqlite3.OperationalError as e:
-        print(f"edit_tag: opError |{str(e)}| for {tag_id},{tag_name}, {tag_class}")
+        print(f"remove_tag: opError |{str(e)}| for {tag_id}")
     return jsonify("")
     
 @bp.route('/api/get_meta')
 def getMetadata():
-    image_id = request.args.get('p')
+    image_id = request.args.get('p', type=int)
     file_path = getPathForImageId(image_id)
     if file_path is None or not os.path.isfile(file_path):
         return jsonify("")
-    with exiftool.ExifToolHelper(common_args=None) as et:
-        metadata = et.get_metadata([file_path])
-    return jsonify(metadata)
+
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    meta = current_app.db.get_image_meta(image_id, mtime_ns)
+    if meta is None:
+        meta = current_app.exiftool.get_metadata([file_path])[0]
+        # not waited on; the next view of this image is served from the db
+        current_app.db_writer.submit(ImageDb.save_image_meta, [(image_id, mtime_ns, meta)], configs.meta_fields)
+    return jsonify([meta])
+
+@bp.route('/meta_values', methods=['GET'])
+def meta_values():
+    field = request.args.get('field')
+    if not field:
+        abort(400)
+    limit = clamp(request.args.get('limit', type=int), 100, 1, 1_000)
+    return jsonify({
+        'field': field,
+        'results': current_app.db.get_meta_values(field, limit),
+    })
 
 @bp.route('/random_search_w_tags', methods=['GET'])
 def random_search_w_tags():
@@ -500,28 +785,22 @@ def random_search_w_tags():
 
     tags = general_tag_ids + character_tag_ids
 
-    randstateEnc = request.args.get('state')
-    restored_state = None
-    if len(randstateEnc) != 0:
-        decoded_state_bytes = base64.b64decode(randstateEnc)
-        restored_state = pickle.loads(decoded_state_bytes)
+    seed = request.args.get('seed', type=int) # empty or missing: pick a new random order
+    folder = request.args.get('folder') or None
+    meta = get_meta_filters()
     
     i1 = perf_counter()
-    results,tot_count,randstate = current_app.db.get_random_images_by_tag_ids(restored_state, tags,
+    results,tot_count,seed = current_app.db.get_random_images_by_tag_ids(seed, tags,
             filters['f_tag'], filters['f_general'], filters['f_sensitive'], filters['f_explicit'], filters['f_questionable'], 
-            page, per_page) 
+            page, per_page, folder, meta) 
     f1 = perf_counter() - i1
 
-    state_bytes = pickle.dumps(randstate)
-    encoded_state = base64.b64encode(state_bytes)    
-    randstateRet = encoded_state.decode('utf-8')
-
     image_count = current_app.db.get_image_count()
     return jsonify({
         'message': f'We searched the tags of {image_count:,} images in {f1:.3f}s and found {tot_count:,} results.',
         'results': results,
         'tot_found': tot_count,
-        'randstate': randstateRet
+        'seed': seed
     })
 
 #===================================================================================    
@@ -531,10 +810,30 @@ flask_app = Flask(__name__)
 logging.getLogger('werkzeug').disabled = True
 
 flask_app.tagger = Tagger(configs)
+flask_app.inference = None
+flask_app.upload_cache = LruCache(configs.upload_cache_entries) # model output by upload sha256
 if configs.allow_file_upload_search:
     flask_app.tagger.load_model()
-
-flask_app.db = FlaskImageDb(configs.db_path, sql_echo=configs.sql_echo)
+    flask_app.inference = InferenceService(flask_app.tagger, configs.min_general_tag_val, configs.min_character_tag_val,
+        max_batch=configs.inference_max_batch, max_wait_ms=configs.inference_max_wait_ms)
+
+flask_app.db = FlaskImageDb(configs.db_path, sql_echo=configs.sql_echo, wal=configs.sqlite_wal,
+    busy_timeout=configs.sqlite_busy_timeout, wal_autocheckpoint=configs.sqlite_wal_autocheckpoint)
+flask_app.db.search_cache = LruCache(configs.search_cache_entries, configs.search_cache_max_ids, weigh=len)
+flask_app.json_cache = EncodedCache()
+flask_app.exiftool = ExifToolPool(configs.exiftool_processes)
+flask_app.jobs = JobManager(configs.max_jobs) # maintenance tasks run alongside requests, at most max_jobs at once
+
+# all writes from the web app go through this one connection, see db_writer.py
+flask_app.db_writer = DbWriter(WriterImageDb(configs.db_path, sql_echo=configs.sql_echo, wal=configs.sqlite_wal,
+    busy_timeout=configs.sqlite_busy_timeout, wal_autocheckpoint=configs.sqlite_wal_autocheckpoint))
+
+if configs.query_stats:
+    flask_app.db.query_stats = QueryStats(configs.slow_query_ms)
+    flask_app.db_writer.db.query_stats = flask_app.db.query_stats
+
+flask_app.thumbnails = ThumbnailCache(configs.thumbnail_dir, size=configs.thumbnail_size, fmt=configs.thumbnail_format,
+    quality=configs.thumbnail_quality, max_bytes=configs.thumbnail_cache_mb * 1024**2, workers=configs.thumbnail_workers)
 
 flask_app.register_blueprint(bp)
 